@@ -0,0 +1,15 @@
+import importlib.util
+import os
+
+from hatchling.builders.hooks.plugin.interface import BuildHookInterface
+
+
+class ParserBuildHook(BuildHookInterface):
+    """Regenerates `demo_lang/parser.py` from `demo_lang/grammar.gram`."""
+
+    def initialize(self, version, build_data):
+        path = os.path.join(self.root, "src", "demo_lang", "grammar.py")
+        spec = importlib.util.spec_from_file_location("demo_lang_grammar", path)
+        grammar = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(grammar)
+        grammar.write_parser()
@@ -1,4 +1,4 @@
-from .compile import ModelGenerator
+from .compile import ModelGenerator, Program
 from .magic import DemoMagics
 
 
@@ -0,0 +1,209 @@
+"""Benchmarks of model generation on the test problems at scale.
+
+Every problem of `demo_lang.problems.sources` has a data generator taking a
+size and a seeded `random.Random`. `run` times the phases of generating a
+model separately and returns one record, which the command line writes as a
+line of JSON so that results of different releases can be compared.
+
+    python -m demo_lang.bench --sizes 20 40 --repeat 3 --output bench.jsonl
+"""
+
+import argparse
+from collections import ChainMap
+import datetime
+import importlib.metadata
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+from . import compile
+from .problems import sources
+
+
+def knapsack(size, rng):
+    # `size` items.
+    return {
+        "p": [rng.randint(1, 100) for _ in range(size)],
+        "w": [rng.randint(1, 100) for _ in range(size)],
+        "c": 25 * size,
+        "I": size,
+    }
+
+
+def travelling_salesman(size, rng):
+    # `size` cities.
+    points = [(rng.random(), rng.random()) for _ in range(size)]
+    return {
+        "n": size,
+        "c": [[round(100 * math.dist(p, q)) for q in points] for p in points],
+    }
+
+
+def n_queens(size, rng):
+    # A `size` by `size` board.
+    return {"n": size}
+
+
+def frequency_assignment(size, rng):
+    # `size` cells.
+    r = [rng.randint(1, 8) for _ in range(size)]
+    d = [[rng.choice([0, 0, 1, 2]) for _ in range(size)] for _ in range(size)]
+    for i in range(size):
+        d[i][i] = 3
+        for j in range(i):
+            d[i][j] = d[j][i]
+    return {"r": r, "d": d, "N": size, "U": sum(map(sum, d)) + sum(r)}
+
+
+def project_scheduling(size, rng):
+    # `size` jobs and the dummy jobs 0 and `size + 1` that start and end the
+    # project.
+    J = size + 2
+    p = [0] + [rng.randint(1, 6) for _ in range(size)] + [0]
+    R = 2
+    u = [[0] * R] + [[rng.randint(0, 5) for _ in range(R)] for _ in range(size)]
+    u.append([0] * R)
+    edges = set()
+    for j in range(2, size + 1):
+        for i in rng.sample(range(1, j), min(2, j - 1)):
+            edges.add((i, j))
+    edges |= {(0, j) for j in range(1, size + 1) if all(e[1] != j for e in edges)}
+    edges |= {(j, size + 1) for j in range(1, size + 1) if all(e[0] != j for e in edges)}
+    X, Y = zip(*sorted(edges))
+    return {
+        "n": size,
+        "p": p,
+        "u": u,
+        "c": [8] * R,
+        "X": list(X),
+        "Y": list(Y),
+        "R": R,
+        "J": J,
+        "T": sum(p),
+    }
+
+
+def job_scheduling(size, rng):
+    # `size` jobs on `size // 2 + 1` machines.
+    n, m = size, size // 2 + 1
+    times = [[rng.randint(1, 9) for _ in range(m)] for _ in range(n)]
+    return {
+        "n": n,
+        "m": m,
+        "times": times,
+        "M": sum(map(sum, times)),
+        "machines": [rng.sample(range(m), m) for _ in range(n)],
+    }
+
+
+def cutting_stock(size, rng):
+    # `size` requests and as many bars.
+    L = 250
+    return {
+        "n": size,
+        "L": L,
+        "m": size,
+        "w": [rng.randint(L // 10, L // 2) for _ in range(size)],
+        "b": [rng.randint(1, 3) for _ in range(size)],
+    }
+
+
+def level_packing(size, rng):
+    # `size` items.
+    return {
+        "w": [rng.randint(1, 7) for _ in range(size)],
+        "h": [rng.randint(1, 6) for _ in range(size)],
+        "n": size,
+        "W": 10,
+    }
+
+
+generators = {
+    "knapsack": knapsack,
+    "travelling_salesman": travelling_salesman,
+    "n_queens": n_queens,
+    "frequency_assignment": frequency_assignment,
+    "project_scheduling": project_scheduling,
+    "job_scheduling": job_scheduling,
+    "cutting_stock": cutting_stock,
+    "level_packing": level_packing,
+}
+
+phases = {"VAR": "variables", "OBJ": "objective", "CONSTR": "constraints"}
+
+
+def run(problem, size, seed=0):
+    """Generate `problem` at `size` and return the time taken by each phase.
+
+    Parsing and compiling bypass the caches. The rows are only loaded into
+    the solver once all constraints are generated, so that loading is timed
+    on its own.
+    """
+    data = generators[problem](size, random.Random(seed))
+    source = sources[problem]
+    times = {}
+    start = time.perf_counter()
+    tree = compile.parse(source)
+    times["parse"] = time.perf_counter() - start
+    start = time.perf_counter()
+    statements = compile.Compiler(tree).program()
+    times["compile"] = time.perf_counter() - start
+    gen = compile.ModelGenerator(problem, source, data)
+    gen.model.verbose = 0
+    gen.rows.chunk = math.inf
+    scope = ChainMap(gen.declared, data)
+    times.update(dict.fromkeys(phases.values(), 0.0))
+    for statement, (kind, *_) in zip(statements, tree[2]):
+        start = time.perf_counter()
+        statement(gen, scope)
+        times[phases[kind]] += time.perf_counter() - start
+    start = time.perf_counter()
+    gen.rows.flush()
+    times["load"] = time.perf_counter() - start
+    return {
+        "problem": problem,
+        "size": size,
+        "seed": seed,
+        **times,
+        "total": sum(times.values()),
+        "num_cols": gen.model.num_cols,
+        "num_rows": gen.model.num_rows,
+        "num_nz": gen.model.num_nz,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m demo_lang.bench")
+    parser.add_argument(
+        "problems", nargs="*", help=f"Any of {', '.join(generators)}, all by default."
+    )
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 20, 40])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=argparse.FileType("a"), default=sys.stdout)
+    args = parser.parse_args(argv)
+    for problem in args.problems:
+        if problem not in generators:
+            parser.error(f"unknown problem {problem}")
+    try:
+        version = importlib.metadata.version("demo_lang")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    context = {
+        "version": version,
+        "python": platform.python_version(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    for problem in args.problems or generators:
+        for size in args.sizes:
+            for repeat in range(args.repeat):
+                record = {**run(problem, size, args.seed), "repeat": repeat, **context}
+                args.output.write(json.dumps(record) + "\n")
+                args.output.flush()
+
+
+if __name__ == "__main__":
+    main()
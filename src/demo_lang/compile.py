@@ -1,121 +1,342 @@
-import ast
-from collections.abc import Generator
+import array
+import bisect
+import builtins
+import bz2
+from collections import ChainMap, OrderedDict
+import concurrent.futures
+import functools
+import gzip
+import hashlib
 import io
+import itertools
+import linecache
+import lzma
+import math
+import multiprocessing
+import operator
+import os
+import pickle
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import tokenize
+import traceback
+import tracemalloc
+from typing import NamedTuple
 
 import mip
 import pegen.tokenizer
-import pegen.utils
 
+from . import grammar
+from .parser import GeneratedParser
 
-def parse(source):
-    grammar = """
-    start: root                                             { ('ROOT', None, root) }
-    root: NEWLINE.statement+
-    statement:
-        | var_statement
-        | obj_statement
-        | constr_statement
-    var_statement: tk='var' var_type lhs=iden '=' rhs=var_expr { ('VAR', var_type, [lhs, rhs], tk) }
-    var_type:
-        | 'cont'                                            { 'CONT' }
-        | 'int'                                             { 'INT' }
-        | 'bin'                                             { 'BIN' }
-    var_expr:
-        | tk='ndarray' '(' shape ')'                        { ('FUNC', 'NDARRAY', shape, tk) }
-    shape: ','.base_expr+                                   
-    constr_statement: tk='constr' expr                      { ('CONSTR', None, [expr], tk) }
-    obj_statement: tk='obj' obj_func expr                   { ('OBJ', obj_func, [expr], tk) }
-    obj_func:
-        | 'min'                                             { 'MIN' }
-        | 'max'                                             { 'MAX' }
-    expr:
-        | func_expr
-        | comp_op_expr
-    func_expr: func=func_iden b=block+ e=expr               { (func[0], func[1], [e, *b], func[2]) }
-    block: tk='(' it=','.iter_expr+ re=rest* ')'            { ('BLOCK', None, [*it, *re], tk) }
-    rest: ',' comp_op_expr                                  { comp_op_expr }
-    func_iden:
-        | tk='sum'                                          { ('FUNC', 'SUM', tk) }
-        | tk='forall'                                       { ('FUNC', 'FORALL', tk) }
-    iter_expr: lhs=iden tk=':=' rhs=set_expr                { ('OP', 'ITER', [lhs, rhs], tk) }
-    set_expr:
-        | lhs=add_sub_op_expr tk=':' rhs=add_sub_op_expr    { ('OP', 'RANGE', [lhs, rhs], tk) }
-        | iden
-    comp_op_expr:
-        | lhs=add_sub_op_expr comp_op rhs=add_sub_op_expr   { (comp_op[0], comp_op[1], [lhs, rhs], comp_op[2]) }
-        | add_sub_op_expr
-    comp_op:
-        | tk='!='                                           { ('OP', 'NE', tk) }
-        | tk='=='                                           { ('OP', 'EQ', tk) }
-        | tk='<='                                           { ('OP', 'LE', tk) }
-        | tk='>='                                           { ('OP', 'GE', tk) }
-        | tk='<'                                            { ('OP', 'LT', tk) }
-        | tk='>'                                            { ('OP', 'GT', tk) }
-    add_sub_op_expr:
-        | lhs=add_sub_op_expr op='+' rhs=mul_div_op_expr    { ('OP', 'ADD', [lhs, rhs], op) }
-        | lhs=add_sub_op_expr op='-' rhs=mul_div_op_expr    { ('OP', 'SUB', [lhs, rhs], op) }
-        | mul_div_op_expr
-    mul_div_op_expr:
-        | lhs=mul_div_op_expr op='*' rhs=base_expr         { ('OP', 'MUL', [lhs, rhs], op) }
-        | lhs=mul_div_op_expr op='/' rhs=base_expr         { ('OP', 'DIV', [lhs, rhs], op) }
-        | base_expr
-    base_expr:
-        | tk='(' val=expr ')'                               { ('OP', 'PAREN', [val], tk) }
-        | slice_expr
-        | iden
-        | value
-    slice_expr: val=iden idx=sub_op+                        { ('OP', 'SLICE', [val, *idx], val[3]) }
-    sub_op: '[' add_sub_op_expr ']'                         { add_sub_op_expr }
-    value: NUMBER                                           { ('VALUE', ast.literal_eval(number.string), [], number) }
-    iden: NAME                                              { ('IDEN', name.string, [], name) }
-    """
 
+def parse(source):
     file = io.StringIO(source)
-    parser_class = pegen.utils.make_parser(grammar)
     tokengen = tokenize.generate_tokens(file.readline)
     tokenizer = pegen.tokenizer.Tokenizer(tokengen, verbose=False)
-    parser = parser_class(tokenizer, verbose=False)
+    parser = GeneratedParser(tokenizer, verbose=False)
     return parser.start()
 
 
-def empty():
-    def evaluator(scope):
-        def generator():
-            yield {}
+def parse_statements(readline):
+    """Parse a program one statement at a time and yield their syntax trees.
+
+    `readline` returns the next line of the source, or an empty string at
+    the end. Only the tokens of the statement being parsed are held. Like
+    `parse`, parsing stops at the first statement that is not understood,
+    together with the rest of its line.
+    """
+    tokens = []
+    for token in tokenize.generate_tokens(readline):
+        if token.type in (tokenize.NL, tokenize.COMMENT):
+            continue
+        tokens.append(token)
+        if token.type not in (tokenize.NEWLINE, tokenize.ENDMARKER):
+            continue
+        if token.type == tokenize.NEWLINE:
+            line = token.end[0] + 1
+            tokens.append(tokenize.TokenInfo(tokenize.ENDMARKER, "", (line, 0), (line, 0), ""))
+        if tokens[0].type == tokenize.ENDMARKER:
+            tokens = []
+            continue
+        tokenizer = pegen.tokenizer.Tokenizer(iter(tokens), verbose=False)
+        tree = GeneratedParser(tokenizer, verbose=False).start()
+        tokens = []
+        if tree is None:
+            return
+        yield from tree[2]
+        if tokenizer.peek().type not in (tokenize.NEWLINE, tokenize.ENDMARKER):
+            return
+
+
+class ParseCache:
+    """LRU cache of syntax trees keyed by the SHA-256 digest of the source.
+
+    Syntax trees are immutable, so every lookup of a source hands out the
+    same tree. With `directory` set, trees are also stored there as
+    `<digest>.pkl` and reused by other processes.
+    """
+
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with open(grammar.grammar_file, "rb") as f:
+            self.grammar_digest = hashlib.sha256(f.read()).digest()
+
+    def digest(self, source):
+        return hashlib.sha256(self.grammar_digest + source.encode()).hexdigest()
+
+    def parse(self, source):
+        key = self.digest(source)
+        with self.lock:
+            tree = self.entries.get(key)
+            if tree is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return tree
+        data = self.load(key)
+        if data is None:
+            tree = parse(source)
+            self.store(key, pickle.dumps(tree))
+        else:
+            tree = pickle.loads(data)
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = tree
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return tree
+
+    def load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, f"{key}.pkl"), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, key, data):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{key}.pkl")
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
 
-        return generator()
+parse_cache = ParseCache()
 
-    return evaluator
 
+def iterate(value):
+    if isinstance(value, int):
+        return range(value)
+    return value
 
-def append(fst, snd):
-    def evaluator(scope):
-        def generator():
-            for f in fst(scope):
-                for s in snd({**scope, **f}):
-                    yield {**f, **s}
 
-        return generator()
+def narrow(values, lower, upper):
+    """Restrict a range of integers to `bound <= value` for every bound in
+    `lower` and to `value < bound` for every bound in `upper`.
+
+    The bounds are integers or infinite, see `ceil_bound`. Returns None when
+    `values` is not a range with step one or a bound is NaN, in which case
+    the caller has to filter the values itself.
+    """
+    if type(values) is not range or values.step != 1:
+        return None
+    start, stop = values.start, values.stop
+    for bound in lower:
+        if bound != bound:
+            return None
+        if bound > start:
+            start = bound
+    for bound in upper:
+        if bound != bound:
+            return None
+        if bound < stop:
+            stop = bound
+    if start >= stop:
+        # Also when an infinite bound leaves nothing.
+        return range(0)
+    return range(start, stop)
+
+
+def ceil_bound(bound):
+    # `math.ceil` of a bound of `narrow`, which passes infinities and NaN on.
+    try:
+        return math.ceil(bound)
+    except (OverflowError, ValueError):
+        return bound
+
+
+def floor_bound(bound):
+    try:
+        return math.floor(bound)
+    except (OverflowError, ValueError):
+        return bound
+
+
+def select(values, masks, *arrays, minimum=32):
+    """Return the elements of a range of integers for which all `masks` hold.
+
+    Every mask is called once with the values that passed the masks before
+    it, as a numpy array, and returns an array of booleans. So a mask never
+    sees a value an earlier one rejects, like with `and`. Returns None, in
+    which case the caller has to
+    filter the values itself, when `values` is not a range with step one or
+    is shorter than `minimum`, when numpy is not installed or when one of
+    `arrays` is None because `as_array` could not convert it.
+    """
+    if type(values) is not range or values.step != 1 or len(values) < minimum:
+        return None
+    if any(array is None for array in arrays):
+        return None
+    try:
+        import numpy
+    except ImportError:
+        return None
+    indices = numpy.arange(values.start, values.stop)
+    for mask in masks:
+        indices = indices[numpy.broadcast_to(mask(indices), indices.shape)]
+    return indices.tolist()
+
+
+def as_array(value, ndim):
+    """Return data as a numeric numpy array with `ndim` dimensions.
+
+    Returns None when numpy is not installed or when `value` is not a list,
+    tuple or array of numbers of that shape, for example a dict or ragged
+    lists.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    if not isinstance(value, (list, tuple, numpy.ndarray)):
+        return None
+    try:
+        array = numpy.asarray(value)
+    except ValueError:
+        return None
+    if array.ndim != ndim or array.dtype.kind not in "biuf":
+        return None
+    return array
 
-    return evaluator
 
+def stored(row, values):
+    """Return the elements of `values` at which `row` may be nonzero.
+
+    A dict, such as the data of a dict of dicts or a row of a `SparseRow`
+    matrix, only holds its nonzeros, so a range of integers is cut down to
+    its keys without going through the range, or the other way around when
+    the range is the shorter. Anything else is returned as it is.
+    """
+    if not isinstance(row, dict) or type(values) is not range or values.step != 1:
+        return values
+    if len(row) >= len(values):
+        return [value for value in values if value in row]
+    return sorted(key for key in row if key in values)
 
-def zip_(fst, snd):
-    def evaluator(scope):
-        def generator():
-            for f, s in zip(fst(scope), snd(scope)):
-                yield {**f, **s}
 
-        return generator()
+class SparseRow(dict):
+    """A row of a sparse matrix, the entries which are not stored are zero."""
 
-    return evaluator
+    def __missing__(self, key):
+        return 0
+
+
+def sparse_rows(matrix):
+    # `lookup` turns `scipy.sparse` matrices into a list of `SparseRow`, which
+    # can be subscripted twice like any other data and works with `stored`.
+    matrix = matrix.tocsr()
+    starts = matrix.indptr.tolist()
+    cols = matrix.indices.tolist()
+    vals = matrix.data.tolist()
+    return [
+        SparseRow(zip(cols[start:end], vals[start:end]))
+        for start, end in zip(starts, starts[1:])
+    ]
+
+
+def linexpr(model, cols, vals, const=0, sense=""):
+    """Build a `mip.LinExpr` from the columns and coefficients of its terms.
+
+    A column may appear more than once, its coefficients are added up. The
+    constant is usually a number but may also be an expression that was
+    passed in through the scope.
+    """
+    coefs = dict(zip(cols, vals))
+    if len(coefs) != len(cols):
+        coefs = dict.fromkeys(cols, 0)
+        for col, val in zip(cols, vals):
+            coefs[col] += val
+    variables = model.vars
+    expr = mip.LinExpr(sense=sense)
+    expr.set_expr({variables[col]: val for col, val in coefs.items()})
+    if isinstance(const, (mip.LinExpr, mip.Var)):
+        expr.add_term(const)
+    else:
+        expr.add_const(const)
+    return expr
+
+
+def untokenized(node):
+    """Return a syntax tree without its tokens, to compare expressions."""
+    kind, value, children, _ = node
+    return (kind, value, tuple(map(untokenized, children)))
+
+
+def lookup(scope, name, message):
+    try:
+        value = scope[name]
+    except KeyError:
+        raise CompilerError(message) from None
+    scipy_sparse = sys.modules.get("scipy.sparse")
+    if scipy_sparse is not None and scipy_sparse.issparse(value):
+        return sparse_rows(value)
+    return value
 
 
 class CompilerError(Exception): ...
 
 
-class ModelGenerator:
+class Compiler:
+    """Translates a syntax tree into python source.
+
+    Every statement becomes a function `statement_<line>(gen, scope)` whose
+    blocks are plain nested `for` loops over local index variables. Other
+    names are read from the scope once, when the function starts. `forall`
+    adds one row to the `RowBuffer` of the generator per iteration of its
+    innermost loop.
+
+    Expressions that are linear in the variables declared by the program are
+    not evaluated with `mip` arithmetic. Their terms are accumulated as column
+    indices and coefficients. They are written straight into the row buffer or
+    turned into a single `mip.LinExpr` by `linexpr`. Anything else is
+    evaluated as is, with `sum` collecting its terms for `mip.xsum`.
+
+    Coefficients, constants and subscripts of variables that do not read the
+    indices of the innermost loop are computed once, in the outermost loop
+    that binds what they read. So are the terms of a linear `sum`, which are
+    reused by every `sum` of the same expression at that level. Nothing is
+    moved out of a block with filters, since those may be what keeps it from
+    failing.
+    """
+
     var_type_map = {
         "CONT": mip.CONTINUOUS,
         "BIN": mip.BINARY,
@@ -123,128 +344,296 @@ class ModelGenerator:
     }
 
     obj_func_map = {
-        "MAX": mip.maximize,
-        "MIN": mip.minimize,
+        "MAX": "mip.maximize",
+        "MIN": "mip.minimize",
     }
 
-    def __init__(self, model_name, source, locals):
-        self.model = mip.Model(model_name)
-        self.root = parse(source)
-        self.locals = locals.copy()
-        self.curr_cursor = self.root
-        self.prev_cursor = None
+    binary_op_map = {
+        "NE": "!=",
+        "EQ": "==",
+        "LE": "<=",
+        "GE": ">=",
+        "LT": "<",
+        "GT": ">",
+        "ADD": "+",
+        "SUB": "-",
+        "MUL": "*",
+        "DIV": "/",
+    }
+
+    sense_map = {
+        "LE": mip.LESS_OR_EQUAL,
+        "GE": mip.GREATER_OR_EQUAL,
+        "EQ": mip.EQUAL,
+    }
+
+    comparison_flip_map = {
+        "LT": "GT",
+        "GT": "LT",
+        "LE": "GE",
+        "GE": "LE",
+        "EQ": "EQ",
+    }
+
+    def __init__(self, root, estimate=False, profile=False, patch=False, write=False):
+        self.curr_cursor = root
+        self.estimate = estimate
+        self.profile = profile
+        self.patch = patch
+        self.write = write
+        self.stack = []
+        self.lines = []
+        self.depth = 0
+        self.indices = {}
+        self.counter = 0
+        self.messages = []
+        self.variables = set()
+        self.sparse = set()
+        self.detached = {}
 
     def enter(self, idx):
-        # print(
-        #     f"enter: {self.curr_cursor[0]} {self.curr_cursor[1]} {idx}"
-        #     f" -> {self.curr_cursor[2][idx][0]} {self.curr_cursor[2][idx][1]}"
-        # )
-        children = self.curr_cursor[2]
-        next_cursor = children[idx]
-        children[idx] = self.prev_cursor
-        self.prev_cursor = self.curr_cursor
-        self.curr_cursor = next_cursor
+        self.stack.append(self.curr_cursor)
+        self.curr_cursor = self.curr_cursor[2][idx]
 
     def exit(self, idx):
-        # print(
-        #     f"exit: {self.curr_cursor[0]} {self.curr_cursor[1]} {idx}"
-        #     f" -> {self.prev_cursor[0]} {self.prev_cursor[1]}"
-        # )
-        next_cursor = self.curr_cursor
-        self.curr_cursor = self.prev_cursor
-        children = self.prev_cursor[2]
-        self.prev_cursor = children[idx]
-        children[idx] = next_cursor
+        self.curr_cursor = self.stack.pop()
 
-    def ndarray(self, var_name, var_type, shape):
-        match shape:
-            case [x]:
-                arr_x = []
-                for i in range(x):
-                    arr_x.append(
-                        self.model.add_var(f"{var_name}_{i}", var_type=var_type)
-                    )
-                return arr_x
-            case [x, y]:
-                arr_x = []
-                for i in range(x):
-                    arr_y = []
-                    for j in range(y):
-                        arr_y.append(
-                            self.model.add_var(f"{var_name}_{i}_{j}", var_type=var_type)
-                        )
-                    arr_x.append(arr_y)
-                return arr_x
-            case [x, y, z]:
-                arr_x = []
-                for i in range(x):
-                    arr_y = []
-                    for j in range(y):
-                        arr_z = []
-                        for k in range(z):
-                            arr_z.append(
-                                self.model.add_var(
-                                    f"{var_name}_{i}_{j}_{k}", var_type=var_type
-                                )
-                            )
-                        arr_y.append(arr_z)
-                    arr_x.append(arr_y)
-                return arr_x
-            case [x, y, z, *_]:
-                raise CompilerError(f"Cannot create arrays with dimension {len(shape)}")
-            case _:
-                raise CompilerError(f"Undefiend array dimension {shape}")
+    def emit(self, line):
+        self.lines.append("    " * self.depth + line)
+
+    def fresh(self, prefix):
+        self.counter += 1
+        return f"{prefix}{self.counter}"
+
+    def bind(self, var_name):
+        local = self.fresh("i") + f"_{var_name}"
+        self.indices[var_name] = local
+        return local
 
-    def generate(self):
+    def program(self):
         children = self.curr_cursor[2]
-        scope = self.locals.copy()
+        names = []
         for idx in range(len(children)):
             self.enter(idx)
-            scope = self.statement()(scope)
+            names.append(self.define())
             self.exit(idx)
-        return scope
+        return self.load(names)
+
+    def feed(self, node):
+        """Compile a single statement and return its function.
+
+        Used to compile a program one statement at a time, see `stream`.
+        Only what the compiler needs to know about the arrays declared so far
+        is kept from earlier statements.
+        """
+        self.curr_cursor = node
+        self.lines = []
+        self.messages = []
+        self.detached = {}
+        (function,) = self.load([self.define()])
+        self.curr_cursor = None
+        return function
+
+    def define(self):
+        name = self.statement()
+        # The columns of sparse arrays are created as they are used, which
+        # only the model itself can do.
+        self.detached[name] = (
+            self.detachable and self.sparse.isdisjoint(self.globals),
+            tuple(self.globals),
+            frozenset(self.fixed.intersection(self.globals)),
+            self.partitioned,
+        )
+        return name
+
+    def load(self, names):
+        # Turns the lines emitted so far into the functions `names`.
+        source = "\n".join(self.lines) + "\n"
+        filename = f"<demo {hashlib.sha256(source.encode()).hexdigest()[:12]}>"
+        linecache.cache[filename] = (
+            len(source),
+            None,
+            source.splitlines(True),
+            filename,
+        )
+        namespace = {
+            "mip": mip,
+            "iterate": iterate,
+            "narrow": narrow,
+            "select": select,
+            "as_array": as_array,
+            "stored": stored,
+            "linexpr": linexpr,
+            "lookup": lookup,
+            "ceil_bound": ceil_bound,
+            "floor_bound": floor_bound,
+            "perf_counter": time.perf_counter,
+            "messages": tuple(self.messages),
+        }
+        exec(builtins.compile(source, filename, "exec"), namespace)
+        for name, (detachable, globals, fixed, partitioned) in self.detached.items():
+            namespace[name].detachable = detachable
+            namespace[name].globals = globals
+            namespace[name].fixed = fixed
+            namespace[name].partitioned = partitioned
+        return tuple(namespace[name] for name in names)
+
+    def function(self, tk_info):
+        name = f"statement_{tk_info.start[0]}"
+        self.depth = 0
+        self.emit(f"def {name}(gen, scope):")
+        self.depth = 1
+        self.indices = {}
+        self.globals = {}
+        self.arrays = {}
+        self.body_start = len(self.lines)
+        # A loop level is `[lines, position, depth, filtered]`, the place
+        # right after the headers and filters of its loops where code that
+        # only depends on the indices bound so far can be moved, see
+        # `invariant`. `filtered` is whether its block has filters. The
+        # statement itself is the outermost level.
+        self.levels = [[self.lines, self.body_start, 1, False]]
+        self.local_levels = {}
+        self.hoisted = {}
+        self.detachable = True
+        self.fixed = set()
+        self.split = False
+        self.partitioned = False
+        self.sites = []
+        self.site_stack = []
+        if self.profile:
+            self.site(self.curr_cursor)
+        return name
+
+    def end_function(self):
+        self.load_globals()
+        if not self.profile:
+            return
+        # Every site counts the iterations of its loops, the iterations its
+        # filters rejected, the terms and the rows it created, the time spent
+        # in its loops and the peak memory allocated in them. The statement
+        # itself is site 0 and is measured by `ModelGenerator.profile`.
+        self.lines[self.body_start : self.body_start] = [
+            f"    tuples{site} = rejected{site} = terms{site} = rows{site} = 0"
+            f"\n    time{site} = 0.0\n    peak{site} = 0"
+            for site, *_ in self.sites
+        ]
+        self.emit(
+            "gen.record(["
+            + ", ".join(
+                f"({kind!r}, {line}, {column}, tuples{site}, rejected{site},"
+                f" terms{site}, rows{site}, time{site}, peak{site})"
+                for site, kind, line, column in self.sites
+            )
+            + "])"
+        )
+
+    def site(self, node):
+        site = self.fresh("_")
+        kind, value, _, tk_info = node
+        self.sites.append(
+            (site, (value if kind == "FUNC" else kind).lower(), *tk_info.start)
+        )
+        self.site_stack.append(site)
+        return site
+
+    def tally(self, counter):
+        if self.profile:
+            self.emit(f"{counter}{self.site_stack[-1]} += 1")
+
+    def load_globals(self):
+        # Names that are not indices are looked up once, when the statement
+        # starts, so the loops only ever touch local variables.
+        self.lines[self.body_start : self.body_start] = [
+            f"    {local} = lookup(scope, {var_name!r}, messages[{message}])"
+            for var_name, (local, message) in self.globals.items()
+        ] + [
+            f"    {local} = as_array({self.globals[var_name][0]}, {ndim})"
+            for var_name, (local, ndim) in self.arrays.items()
+        ]
 
     def statement(self):
         match self.curr_cursor:
-            case ("VAR", var_type, _, _):
+            case ("VAR", var_type, _, tk_info):
+                name = self.function(tk_info)
+                self.detachable = False
                 var_type_str = self.var_type_map[var_type]
                 self.enter(0)
                 var_name = self.var_lhs()
                 self.exit(0)
                 self.enter(1)
-                expr_eval = self.var_expr(var_name, var_type_str)
+                expr = self.var_expr(var_name, var_type_str)
                 self.exit(1)
-
-                def evaluator(scope):
-                    scope[var_name] = expr_eval(scope)
-                    return scope
-
-                return evaluator
-            case ("OBJ", obj_func, _, _):
+                self.emit(f"scope[{var_name!r}] = {expr}")
+                self.variables.add(var_name)
+                if self.curr_cursor[2][1][1] == "SPARSE":
+                    self.sparse.add(var_name)
+                self.fixed.update(self.globals)
+                self.end_function()
+                return name
+            case ("OBJ", obj_func, _, tk_info) if self.estimate:
+                name = self.function(tk_info)
+                self.emit("pass")
+                return name
+            case ("OBJ", obj_func, _, tk_info) if self.write:
+                name = self.function(tk_info)
+                self.detachable = False
                 self.enter(0)
-                expr_eval = self.expr()
+                names = self.linear_names()
+                if self.linear_form(self.curr_cursor, names) not in (0, 1):
+                    self.not_linear("objective")
+                terms = (self.fresh("c"), self.fresh("v"), self.fresh("k"))
+                self.emit(f"{terms[0]}, {terms[1]}, {terms[2]} = [], [], 0")
+                self.accumulate(terms, "1")
                 self.exit(0)
-
-                def evaluator(scope):
-                    self.model.objective = self.obj_func_map[obj_func](expr_eval(scope))
-                    return scope
-
-                return evaluator
-            case ("CONSTR", None, _, _):
+                self.emit(f"gen.objective({obj_func!r}, {', '.join(terms)})")
+                self.end_function()
+                return name
+            case ("OBJ", obj_func, _, tk_info):
+                name = self.function(tk_info)
+                self.detachable = False
+                self.emit("model = gen.model")
                 self.enter(0)
-                expr_eval = self.expr()
+                if self.linear_form(self.curr_cursor, self.linear_names()) == 1:
+                    expr = self.linear(self.accumulate)
+                else:
+                    expr = self.expr()
                 self.exit(0)
-
-                def evaluator(scope):
-                    expr = expr_eval(scope)
-                    if isinstance(expr, Generator):
-                        for e in expr:
-                            self.model.add_constr(e)
-                    else:
-                        self.model.add_constr(expr)
-                    return scope
-
-                return evaluator
+                self.emit(f"model.objective = {self.obj_func_map[obj_func]}({expr})")
+                self.end_function()
+                return name
+            case ("CONSTR", None, _, tk_info) if self.estimate:
+                name = self.function(tk_info)
+                self.emit("n_rows = 0")
+                self.emit("n_terms = 0")
+                self.counted = True
+                self.enter(0)
+                match self.curr_cursor:
+                    case ("FUNC", "FORALL", children, _):
+                        self.count_loops(children, 1, "1", self.count_row)
+                    case _:
+                        self.count_row("1")
+                self.exit(0)
+                self.emit(f"gen.count(n_rows, {'n_terms' if self.counted else None})")
+                self.end_function()
+                return name
+            case ("CONSTR", None, _, tk_info):
+                name = self.function(tk_info)
+                self.emit("model = gen.model")
+                self.emit("rows = gen.rows")
+                if not self.patch:
+                    self.emit("cols, vals = rows.cols, rows.vals")
+                self.enter(0)
+                match self.curr_cursor:
+                    case ("FUNC", "FORALL", children, _):
+                        self.fixed.update(*map(self.names_in, children[1:]))
+                        self.split = True
+                        self.func(self.constraint)
+                    case _:
+                        self.constraint()
+                self.exit(0)
+                self.end_function()
+                return name
             case _:
                 raise CompilerError(
                     f"Expected a statement at the start of the program instead found: {self.curr_cursor[0:2]}"
@@ -258,14 +647,15 @@ class ModelGenerator:
 
     def var_expr(self, var_name, var_type):
         match self.curr_cursor:
-            case ("FUNC", "NDARRAY", shape, _):
+            case ("FUNC", "NDARRAY" | "SPARSE" as func, shape, _):
                 shape_arr = []
                 for i in range(len(shape)):
                     self.enter(i)
                     shape_arr.append(self.base_expr())
                     self.exit(i)
-                return lambda s: self.ndarray(
-                    var_name, var_type, [ee(s) for ee in shape_arr]
+                return (
+                    f"gen.{func.lower()}({var_name!r}, {var_type!r},"
+                    f" [{', '.join(shape_arr)}])"
                 )
             case _:
                 raise CompilerError(
@@ -278,7 +668,7 @@ class ModelGenerator:
     def value(self):
         match self.curr_cursor:
             case ("VALUE", num, _, _):
-                return lambda scope: num
+                return repr(num)
             case _:
                 raise CompilerError(
                     f"Expected a value instead found the token {self.curr_cursor[0]}"
@@ -301,19 +691,19 @@ class ModelGenerator:
 
     def iden_rhs(self):
         match self.curr_cursor:
-            case ("IDEN", var_name, [], tk_info):
-
-                def evaluator(scope):
-                    if var_name not in scope:
-                        raise CompilerError(
-                            f"Undefiend variable {self.curr_cursor[0:2]}"
-                            f" at {self.curr_cursor[3].start} on line \n"
-                            f"{self.curr_cursor[3].line}"
-                            f"{' ' * (self.curr_cursor[3].start[1] - 1)}^"
-                        )
-                    return scope[var_name]
-
-                return evaluator
+            case ("IDEN", var_name, [], _):
+                if var_name in self.indices:
+                    return self.indices[var_name]
+                message = (
+                    f"Undefiend variable {self.curr_cursor[0:2]}"
+                    f" at {self.curr_cursor[3].start} on line \n"
+                    f"{self.curr_cursor[3].line}"
+                    f"{' ' * (self.curr_cursor[3].start[1] - 1)}^"
+                )
+                if var_name not in self.globals:
+                    self.messages.append(message)
+                    self.globals[var_name] = (f"g_{var_name}", len(self.messages) - 1)
+                return self.globals[var_name][0]
             case _:
                 raise CompilerError(
                     f"Unexpected token {self.curr_cursor[0:2]}"
@@ -352,30 +742,25 @@ class ModelGenerator:
                     f"{' ' * (self.curr_cursor[3].start[1] - 1)}^"
                 )
 
-    def func(self):
+    def func(self, sink=None):
         match self.curr_cursor:
             case ("FUNC", "SUM", children, _):
-                block_evals = []
-                for idx in range(1, len(children)):
-                    self.enter(idx)
-                    block_evals.append(self.block())
-                    self.exit(idx)
-                self.enter(0)
-                expr_eval = self.expr()
-                self.exit(0)
-                block_eval = self.compose_blocks(block_evals, expr_eval)
-                return lambda scope: mip.xsum(block_eval(scope))
-            case ("FUNC", "FORALL", children, _):
-                block_evals = []
-                for idx in range(1, len(children)):
-                    self.enter(idx)
-                    block_evals.append(self.block())
-                    self.exit(idx)
-                self.enter(0)
-                expr_eval = self.expr()
-                self.exit(0)
-                block_eval = self.compose_blocks(block_evals, expr_eval)
-                return block_eval
+                if self.linear_form(self.curr_cursor, self.linear_names()) == 1:
+                    return self.linear(self.accumulate)
+                self.detachable = False
+                terms = self.fresh("t")
+                self.emit(f"{terms} = []")
+                self.loops(children, lambda: self.append_term(terms))
+                return f"mip.xsum({terms})"
+            case ("FUNC", "FORALL", children, _) if sink is not None:
+                self.loops(children, sink)
+            case ("FUNC", "FORALL", _, _):
+                raise CompilerError(
+                    f"Expected forall only at the start of a constraint"
+                    f" at {self.curr_cursor[3].start} on line \n"
+                    f"{self.curr_cursor[3].line}"
+                    f"{' ' * (self.curr_cursor[3].start[1] - 1)}^"
+                )
             case ("FUNC", *_):
                 raise CompilerError(
                     f"Unknow function {self.curr_cursor[1]} encountered"
@@ -384,40 +769,595 @@ class ModelGenerator:
                     f"{' ' * (self.curr_cursor[3].start[1] - 1)}^"
                 )
 
-    def compose_blocks(self, block_evals, expr_eval):
-        def evaluator(scope):
-            index_eval = empty()
-            for block_eval in block_evals:
-                index_eval = append(index_eval, block_eval)
-            for indices in index_eval(scope):
-                s = {**scope, **indices}
-                yield expr_eval(s)
+    def loops(self, children, body, factor=None):
+        # `body` is called in the innermost loop with the cursor on the
+        # expression being iterated. `factor` is the path of a data factor of
+        # that expression that the last loop only has to visit the stored
+        # entries of, see `stored_factor`.
+        if self.profile:
+            site = self.site(self.curr_cursor)
+            self.emit(f"memory{site} = gen.enter_site()")
+            self.emit(f"time{site} -= perf_counter()")
+        indices = self.indices.copy()
+        depth = self.depth
+        levels = len(self.levels)
+        for idx in range(1, len(children)):
+            row = None
+            if factor is not None and idx == len(children) - 1:
+                row = self.stored_row(factor)
+            self.enter(idx)
+            self.block(row)
+            self.exit(idx)
+        self.enter(0)
+        body()
+        self.exit(0)
+        self.indices = indices
+        self.depth = depth
+        del self.levels[levels:]
+        if self.profile:
+            self.emit(f"time{site} += perf_counter()")
+            self.emit(f"peak{site} = max(peak{site}, gen.exit_site(memory{site}))")
+            self.site_stack.pop()
 
-        return evaluator
+    def append_term(self, terms):
+        self.emit(f"{terms}.append({self.expr()})")
+        self.tally("terms")
 
-    def block(self):
+    def constraint(self):
+        names = self.linear_names()
+        match self.curr_cursor:
+            case ("OP", "PAREN", [("OP", *_)], _):
+                self.enter(0)
+                self.constraint()
+                self.exit(0)
+            case ("OP", "LE" | "GE" | "EQ" as op, [lhs, rhs], _) if (
+                self.linear_form(lhs, names) in (0, 1)
+                and self.linear_form(rhs, names) in (0, 1)
+                and 1 in (self.linear_form(lhs, names), self.linear_form(rhs, names))
+            ):
+                # The row is written straight into the buffer of the generator.
+                # When patching only its constant is computed.
+                const = self.fresh("k")
+                self.emit(f"{const} = 0")
+                self.fixed.update(self.fixed_names(self.curr_cursor, names))
+                if self.patch:
+                    self.compare((None, None, const), "1")
+                    self.emit(f"rows.patch({const})")
+                else:
+                    self.compare(("cols", "vals", const), "1")
+                    self.emit(f"rows.end({const}, {self.sense_map[op]!r})")
+                self.tally("rows")
+            case _ if self.write:
+                self.not_linear("constraint")
+            case _:
+                self.fixed.update(self.names_in(self.curr_cursor))
+                self.emit(f"rows.add_constr({self.expr()})")
+                self.tally("rows")
+                self.detachable = False
+
+    def not_linear(self, what):
+        # Without a model there is nothing to evaluate `mip` expressions with.
+        raise CompilerError(
+            f"Only a linear {what} can be written to a file, found {self.curr_cursor[0:2]}"
+            f" at {self.curr_cursor[3].start} on line \n"
+            f"{self.curr_cursor[3].line}"
+            f"{' ' * (self.curr_cursor[3].start[1] - 1)}^"
+        )
+
+    def linear(self, accumulate, *args):
+        """Accumulate the current expression and return the code of its `LinExpr`."""
+        self.detachable = False
+        terms = (self.fresh("c"), self.fresh("v"), self.fresh("k"))
+        self.emit(f"{terms[0]}, {terms[1]}, {terms[2]} = [], [], 0")
+        accumulate(terms, "1")
+        return f"linexpr(model, {', '.join(terms)}{''.join(f', {a!r}' for a in args)})"
+
+    def compare(self, terms, coef):
+        # `lhs <op> rhs` is accumulated as `lhs - rhs <op> 0`.
+        self.enter(0)
+        self.accumulate(terms, coef)
+        self.exit(0)
+        self.enter(1)
+        self.accumulate(terms, self.negate(coef))
+        self.exit(1)
+
+    def accumulate(self, terms, coef):
+        """Emit code adding `coef` times the current expression to `terms`.
+
+        `terms` are the names of the column list, the coefficient list and the
+        constant. Without lists only the constant is accumulated. The
+        expression must be linear, see `linear_form`.
+        """
+        cols, vals, const = terms
+        node = self.curr_cursor
+        names = self.linear_names()
+        if self.linear_form(node, names) == 0:
+            code = self.scale(coef, self.operand())
+            self.emit(f"{const} += {self.invariant(code, [node], coef)}")
+            return
+        if cols is None and not self.constant_part(node, names):
+            return
+        match node:
+            case ("OP", "ADD" | "SUB" as op, _, _):
+                self.enter(0)
+                self.accumulate(terms, coef)
+                self.exit(0)
+                self.enter(1)
+                self.accumulate(terms, coef if op == "ADD" else self.negate(coef))
+                self.exit(1)
+            case ("OP", "MUL", [lhs, _], _):
+                factor, term = (0, 1) if self.linear_form(lhs, names) == 0 else (1, 0)
+                self.enter(factor)
+                coef = self.coefficient(
+                    self.scale(coef, self.operand()), [self.curr_cursor], coef
+                )
+                self.exit(factor)
+                # A zero coefficient leaves out the term, with all its loops.
+                depth = self.depth
+                try:
+                    nonzero = float(coef) != 0
+                except ValueError:
+                    self.emit(f"if {coef}:")
+                    self.depth += 1
+                    nonzero = True
+                if nonzero:
+                    self.enter(term)
+                    self.accumulate(terms, coef)
+                    self.exit(term)
+                self.depth = depth
+            case ("OP", "DIV", _, _):
+                self.enter(1)
+                coef = self.coefficient(
+                    f"{coef} / {self.operand()}", [self.curr_cursor], coef
+                )
+                self.exit(1)
+                self.enter(0)
+                self.accumulate(terms, coef)
+                self.exit(0)
+            case ("OP", "PAREN", _, _):
+                self.enter(0)
+                self.accumulate(terms, coef)
+                self.exit(0)
+            case ("OP", "SLICE", children, _):
+                subscripts = []
+                for idx in range(len(children)):
+                    self.enter(idx)
+                    subscripts.append(self.invariant(self.op_expr(), [children[idx]]))
+                    self.exit(idx)
+                array, *subscripts = subscripts
+                self.emit(f"{cols}.append({array}.index({', '.join(subscripts)}))")
+                self.emit(f"{vals}.append({coef})")
+                self.tally("terms")
+            case ("FUNC", "SUM", children, _):
+                if not self.hoist_sum(terms, coef):
+                    self.loops(
+                        children,
+                        lambda: self.accumulate(terms, coef),
+                        self.stored_factor(children, names),
+                    )
+
+    def hoist_sum(self, terms, coef):
+        """Accumulate the `sum` at the cursor once at an outer loop level.
+
+        This is done when the `sum` does not read the indices of the current
+        level. Its terms are then collected into lists of their own once per
+        iteration of the level where its indices are bound, the first time
+        the `sum` is reached, and the current level only adds them to
+        `terms`. Returns whether the `sum` was hoisted.
+        """
+        node = self.curr_cursor
+        level = self.target_level([node])
+        if level is None or level is self.levels[-1]:
+            return False
+        cols, vals, const = terms
+        key = (id(level), cols is None, untokenized(node))
+        hoisted, reached = self.hoisted.get(key, (None, None))
+        if hoisted is None:
+            if cols is None:
+                hoisted = (None, None, self.fresh("h"))
+            else:
+                hoisted = (self.fresh("h"), self.fresh("h"), self.fresh("h"))
+            self.insert(level, [f"{'    ' * level[2]}{hoisted[2]} = None"])
+        if reached is not self.levels[-1]:
+            self.emit(f"if {hoisted[2]} is None:")
+            self.depth += 1
+            self.emit(
+                f"{hoisted[2]} = 0" if cols is None
+                else f"{hoisted[0]}, {hoisted[1]}, {hoisted[2]} = [], [], 0"
+            )
+            children = node[2]
+            self.loops(
+                children,
+                lambda: self.accumulate(hoisted, "1"),
+                self.stored_factor(children, self.linear_names()),
+            )
+            self.depth -= 1
+        self.hoisted[key] = (hoisted, self.reached())
+        if cols is not None:
+            self.emit(f"{cols}.extend({hoisted[0]})")
+            if coef == "1":
+                self.emit(f"{vals}.extend({hoisted[1]})")
+            else:
+                self.emit(f"{vals}.extend([{coef} * val for val in {hoisted[1]}])")
+        self.emit(f"{const} += {self.scale(coef, hoisted[2])}")
+        return True
+
+    def stored_factor(self, children, names):
+        """Return the path of a factor `data[...][j]` of the body of a `sum`.
+
+        `j` must be the only index of the last block and the other subscripts
+        must not depend on it. The body is zero wherever the factor is, so
+        the last loop can go through the entries stored in `data[...]` only.
+        The path is relative to the `sum` and is None without such a factor.
+        """
+        iterators = [child for child in children[-1][2] if child[:2] == ("OP", "ITER")]
+        if len(children) < 2 or len(iterators) != 1:
+            return None
+        index = iterators[0][2][0][1]
+        bound = self.bound_names(children[1:])
+        for path, node in self.zero_factors(children[0], [0]):
+            match node:
+                case ("OP", "SLICE", [("IDEN", name, [], _), *rest], _) if (
+                    len(rest) > 1
+                    and rest[-1][:2] == ("IDEN", index)
+                    and name not in names
+                    and name not in bound
+                    and name not in self.indices
+                    and not any(self.depends_on(s, index) for s in rest[:-1])
+                ):
+                    return path
+        return None
+
+    def zero_factors(self, node, path):
+        # Yields the factors that make `node` zero when they are, with their
+        # paths.
+        match node:
+            case ("OP", "MUL", [lhs, rhs], _):
+                yield from self.zero_factors(lhs, path + [0])
+                yield from self.zero_factors(rhs, path + [1])
+            case ("OP", "DIV" | "PAREN", [expr, *_], _):
+                yield from self.zero_factors(expr, path + [0])
+            case _:
+                yield path, node
+
+    def stored_row(self, path):
+        # The code of `data[...]` for the factor `data[...][j]` at `path`.
+        for idx in path:
+            self.enter(idx)
+        code = []
+        for idx in range(len(self.curr_cursor[2]) - 1):
+            self.enter(idx)
+            code.append(self.op_expr())
+            self.exit(idx)
+        for idx in reversed(path):
+            self.exit(idx)
+        return code[0] + "".join(f"[{c}]" for c in code[1:])
+
+    def count_loops(self, children, idx, factor, body):
+        """Emit the loops of `children[idx:]` for counting.
+
+        A block without filters whose variables the rest of the loops do not
+        depend on is not enumerated, its size multiplies `factor` instead.
+        `body` is called with the cursor on the expression being iterated.
+        """
+        if idx == len(children):
+            self.enter(0)
+            body(factor)
+            self.exit(0)
+            return
+        block = children[idx]
+        iterators = [child for child in block[2] if child[:2] == ("OP", "ITER")]
+        if len(iterators) == len(block[2]) and not any(
+            self.shape_depends_on(node, iterator[2][0][1])
+            for node in (*children[idx + 1 :], children[0])
+            for iterator in iterators
+        ):
+            sizes = []
+            self.enter(idx)
+            for i in range(len(iterators)):
+                self.enter(i)
+                sizes.append(f"len({self.iter_expr()[1]})")
+                self.exit(i)
+            self.exit(idx)
+            size = self.extremum("min", sizes)
+            factor = self.coefficient(self.scale(factor, size), iterators, factor)
+            self.count_loops(children, idx + 1, factor, body)
+            return
+        indices = self.indices.copy()
+        depth = self.depth
+        levels = len(self.levels)
+        self.enter(idx)
+        self.block()
+        self.exit(idx)
+        self.count_loops(children, idx + 1, factor, body)
+        self.indices = indices
+        self.depth = depth
+        del self.levels[levels:]
+
+    def count_row(self, factor):
+        names = self.linear_names()
+        match self.curr_cursor:
+            case ("OP", "PAREN", [("OP", *_)], _):
+                self.enter(0)
+                self.count_row(factor)
+                self.exit(0)
+                return
+            case ("OP", "LE" | "GE" | "EQ", [lhs, rhs], _) if (
+                self.linear_form(lhs, names) in (0, 1)
+                and self.linear_form(rhs, names) in (0, 1)
+            ):
+                for idx in range(2):
+                    self.enter(idx)
+                    self.count_terms(factor)
+                    self.exit(idx)
+            case _:
+                self.counted = False
+        self.emit(f"n_rows += {factor}")
+
+    def count_terms(self, factor):
+        node = self.curr_cursor
+        if self.linear_form(node, self.linear_names()) == 0:
+            return
+        match node:
+            case ("OP", "ADD" | "SUB" | "PAREN", children, _):
+                for idx in range(len(children)):
+                    self.enter(idx)
+                    self.count_terms(factor)
+                    self.exit(idx)
+            case ("OP", "MUL" | "DIV", [lhs, _], _):
+                term = 1 if self.linear_form(lhs, self.linear_names()) == 0 else 0
+                self.enter(term)
+                self.count_terms(factor)
+                self.exit(term)
+            case ("OP", "SLICE", _, _):
+                self.emit(f"n_terms += {factor}")
+            case ("FUNC", "SUM", children, _):
+                self.count_loops(children, 1, factor, self.count_terms)
+
+    def shape_depends_on(self, node, var_name):
+        # Only the sets and filters of the blocks decide how many terms and
+        # rows there are, the coefficients do not matter.
+        match node:
+            case ("BLOCK", *_):
+                return self.depends_on(node, var_name)
+            case ("FUNC", _, [expr, *blocks], _):
+                return any(
+                    self.depends_on(block, var_name) for block in blocks
+                ) or self.shape_depends_on(expr, var_name)
+            case (_, _, children, _):
+                return any(self.shape_depends_on(child, var_name) for child in children)
+        return False
+
+    def operand(self):
+        if self.curr_cursor[0] == "FUNC":
+            return self.func()
+        return self.op_expr()
+
+    def coefficient(self, code, nodes, coef="1"):
+        # Coefficients are stored in a local once they are more than a name
+        # or a number, so that the loops of a nested sum do not recompute them.
+        if self.trivial(code):
+            return code
+        hoisted = self.invariant(code, nodes, coef)
+        if hoisted != code:
+            return hoisted
+        local = self.fresh("k")
+        self.emit(f"{local} = {code}")
+        return local
+
+    def trivial(self, code):
+        return code.lstrip("-").replace(".", "").replace("_", "").isalnum()
+
+    def invariant(self, code, nodes, coef="1"):
+        """Return a local holding `code`, computed once per outermost level it can be.
+
+        `code` is computed from the syntax trees `nodes`, times `coef`. See
+        `target_level` for that level. When it is the current level, or
+        `code` cannot be moved because it reads a local computed in place, it
+        is returned as it is. Otherwise the local is reset to None at that
+        level and `code` is computed where it is used, the first time it is
+        reached. Nothing is computed when the loops in between are empty,
+        where the code may fail, and the same code is only computed once per
+        iteration of that level.
+        """
+        if self.trivial(code) or any(map(self.has_sum, nodes)):
+            # `operand` evaluates a `sum` in place, before `code`.
+            return code
+        level = self.target_level(nodes, coef)
+        if level is None or level is self.levels[-1]:
+            return code
+        key = (id(level), code)
+        local, reached = self.hoisted.get(key, (None, None))
+        if local is None:
+            local = self.fresh("h")
+            self.insert(level, [f"{'    ' * level[2]}{local} = None"])
+            self.local_levels[local] = level
+        if reached is not self.levels[-1]:
+            self.emit(f"if {local} is None:")
+            self.depth += 1
+            self.emit(f"{local} = {code}")
+            self.depth -= 1
+        self.hoisted[key] = (local, self.reached())
+        return local
+
+    def reached(self):
+        # The current level when the code emitted now runs on every iteration
+        # of it, so that a hoisted local computed here is set for the code
+        # after it.
+        level = self.levels[-1]
+        return level if self.depth == level[2] else None
+
+    def target_level(self, nodes, coef="1"):
+        """Return the outermost level where what `nodes` compute can be moved.
+
+        That is the innermost level binding an index the nodes read, or
+        holding the local `coef`, but never outside a block with filters,
+        which may be what keeps the code from failing. Returns None when
+        `coef` is a local computed in place, so nothing can move above it.
+        """
+        level = next((l for l in reversed(self.levels) if l[3]), self.levels[0])
+        named = []
+        if not self.trivial(coef):
+            named.append(self.local_levels.get(coef.lstrip("-")))
+        for node in nodes:
+            named.extend(
+                self.local_levels.get(self.indices[name])
+                for name in self.names_in(node) & self.indices.keys()
+            )
+        for other in named:
+            if other is None or not any(other is l for l in self.levels):
+                return None
+            if self.level_index(other) > self.level_index(level):
+                level = other
+        return level
+
+    def has_sum(self, node):
+        return node[0] == "FUNC" or any(map(self.has_sum, node[2]))
+
+    def level_index(self, level):
+        return next(idx for idx, l in enumerate(self.levels) if l is level)
+
+    def insert(self, level, lines):
+        # Inserts the lines at `level`, after the lines moved there before.
+        target, position, *_ = level
+        target[position:position] = lines
+        for other in self.levels:
+            if other[0] is target and other[1] >= position:
+                other[1] += len(lines)
+
+    def scale(self, coef, code):
+        match coef:
+            case "1":
+                return code
+            case "-1":
+                return f"-{code}"
+        return f"{coef} * {code}"
+
+    def negate(self, coef):
+        return coef[1:] if coef.startswith("-") else f"-{coef}"
+
+    def linear_names(self):
+        return self.variables.difference(self.indices)
+
+    def linear_form(self, node, names):
+        """Return the degree of an expression in the variables in `names`.
+
+        The degree is 0 for a constant and 1 for sums, differences, products
+        and quotients by constants and `sum` of variable elements. It is None
+        for anything else, which is then left to `mip` to evaluate.
+        """
+        match node:
+            case ("VALUE", *_):
+                return 0
+            case ("IDEN", name, [], _):
+                return None if name in names else 0
+            case ("OP", "SLICE", [("IDEN", name, [], _), *subscripts], _):
+                if any(self.linear_form(s, names) != 0 for s in subscripts):
+                    return None
+                return 1 if name in names else 0
+            case ("OP", "ADD" | "SUB", [lhs, rhs], _):
+                forms = (self.linear_form(lhs, names), self.linear_form(rhs, names))
+                return None if None in forms else max(forms)
+            case ("OP", "MUL", [lhs, rhs], _):
+                forms = (self.linear_form(lhs, names), self.linear_form(rhs, names))
+                return None if None in forms or sum(forms) > 1 else sum(forms)
+            case ("OP", "DIV", [lhs, rhs], _):
+                if self.linear_form(rhs, names) != 0:
+                    return None
+                return self.linear_form(lhs, names)
+            case ("OP", "PAREN", [expr], _):
+                return self.linear_form(expr, names)
+            case ("OP", "LT" | "GT" | "LE" | "GE" | "EQ" | "NE" | "RANGE", [lhs, rhs], _):
+                forms = (self.linear_form(lhs, names), self.linear_form(rhs, names))
+                return 0 if forms == (0, 0) else None
+            case ("FUNC", "SUM", [expr, *blocks], _):
+                bound = set()
+                for block in blocks:
+                    for child in block[2]:
+                        match child:
+                            case ("OP", "ITER", [("IDEN", var_name, _, _), values], _):
+                                if self.linear_form(values, names - bound) != 0:
+                                    return None
+                                bound.add(var_name)
+                for block in blocks:
+                    for child in block[2]:
+                        if child[:2] != ("OP", "ITER") and self.linear_form(child, names - bound) != 0:
+                            return None
+                return self.linear_form(expr, names - bound)
+        return None
+
+    def constant_part(self, node, names):
+        # Whether a linear expression has terms without any variable.
+        if self.linear_form(node, names) == 0:
+            return True
+        match node:
+            case ("OP", "ADD" | "SUB", [lhs, rhs], _):
+                return self.constant_part(lhs, names) or self.constant_part(rhs, names)
+            case ("OP", "MUL", [lhs, rhs], _):
+                term = rhs if self.linear_form(lhs, names) == 0 else lhs
+                return self.constant_part(term, names)
+            case ("OP", "DIV" | "PAREN", [expr, *_], _):
+                return self.constant_part(expr, names)
+            case ("FUNC", "SUM", [expr, *blocks], _):
+                return self.constant_part(expr, names - self.bound_names(blocks))
+        return False
+
+    def fixed_names(self, node, names):
+        """Return the names that decide the rows of a linear constraint.
+
+        These are the names in the blocks, in the subscripts of the variables
+        and in their coefficients. Any other name only changes the constants,
+        which `ModelGenerator.update` can patch.
+        """
+        if self.linear_form(node, names) == 0:
+            return set()
+        match node:
+            case ("OP", "MUL", [lhs, rhs], _):
+                factor, term = (lhs, rhs) if self.linear_form(lhs, names) == 0 else (rhs, lhs)
+                return self.names_in(factor) | self.fixed_names(term, names)
+            case ("OP", "DIV", [lhs, rhs], _):
+                return self.fixed_names(lhs, names) | self.names_in(rhs)
+            case ("OP", "SLICE", [_, *subscripts], _):
+                return set().union(*map(self.names_in, subscripts))
+            case ("FUNC", "SUM", [expr, *blocks], _):
+                return set().union(
+                    self.fixed_names(expr, names - self.bound_names(blocks)),
+                    *map(self.names_in, blocks),
+                )
+            case (_, _, children, _):
+                return set().union(*(self.fixed_names(c, names) for c in children))
+
+    def names_in(self, node):
+        match node:
+            case ("IDEN", name, _, _):
+                return {name}
+            case (_, _, children, _):
+                return set().union(*map(self.names_in, children))
+
+    def bound_names(self, blocks):
+        return {
+            child[2][0][1]
+            for block in blocks
+            for child in block[2]
+            if child[:2] == ("OP", "ITER")
+        }
+
+    def block(self, row=None):
+        # With `row`, the code of the data the body is zero without, the block
+        # only goes through the keys stored in it, see `stored_set`. The loops
+        # of the block start a new loop level.
+        indices = self.indices.copy()
         match self.curr_cursor:
             case ("BLOCK", None, children, _):
-                iter_evals = []
-                comp_evals = []
+                iter_exprs = []
+                comp_idxs = []
                 for idx in range(len(children)):
                     self.enter(idx)
-                    expr_eval = self.op_expr()
                     match self.curr_cursor:
                         case ("OP", "ITER", _, _):
-                            iter_evals.append(expr_eval)
-                        case ("OP", "LT", _, _):
-                            comp_evals.append(expr_eval)
-                        case ("OP", "GT", _, _):
-                            comp_evals.append(expr_eval)
-                        case ("OP", "LE", _, _):
-                            comp_evals.append(expr_eval)
-                        case ("OP", "GE", _, _):
-                            comp_evals.append(expr_eval)
-                        case ("OP", "EQ", _, _):
-                            comp_evals.append(expr_eval)
-                        case ("OP", "NE", _, _):
-                            comp_evals.append(expr_eval)
+                            iter_exprs.append(self.iter_expr())
+                        case ("OP", "LT" | "GT" | "LE" | "GE" | "EQ" | "NE", _, _):
+                            comp_idxs.append(idx)
                         case _:
                             raise CompilerError(
                                 f"Expected iter or comp expr instead found: {self.curr_cursor[0:2]}"
@@ -426,22 +1366,77 @@ class ModelGenerator:
                                 f"{' ' * (self.curr_cursor[3].start[1] - 1)}^"
                             )
                     self.exit(idx)
-
-                def evaluator(scope):
-                    def generator():
-                        index_eval = iter_evals[0]
-                        for iter_eval in iter_evals[1:]:
-                            index_eval = zip_(index_eval, iter_eval)
-                        for val in index_eval(scope):
-                            cond = True
-                            for e in comp_evals:
-                                cond = cond and e({**scope, **val})
-                            if cond:
-                                yield val
-
-                    return generator()
-
-                return evaluator
+                bounds = {}
+                masks = {}
+                vector = None
+                if len(iter_exprs) == 1:
+                    # A comparison only leaves the loop when all those before
+                    # it did, bounds first and then masks, so that it is never
+                    # evaluated for an index an earlier one rejects.
+                    var_name = iter_exprs[0][0]
+                    vector = self.fresh("v")
+                    for idx in comp_idxs:
+                        if not masks:
+                            bound = self.pushdown(children[idx], var_name)
+                            if bound is not None:
+                                bounds[idx] = bound
+                                continue
+                        if row is not None or not self.depends_on(
+                            children[idx], var_name
+                        ):
+                            break
+                        arrays = []
+                        self.enter(idx)
+                        mask = self.vector_expr(var_name, vector, arrays)
+                        self.exit(idx)
+                        if mask is None:
+                            break
+                        masks[idx] = (mask, arrays)
+                conds = []
+                for idx in comp_idxs:
+                    if row is None or idx in bounds or idx in masks:
+                        continue
+                    if self.depends_on(children[idx], var_name):
+                        # Whether the body reads `row` at all is then only
+                        # known element by element.
+                        row = None
+                        break
+                    self.enter(idx)
+                    conds.append(self.op_expr())
+                    self.exit(idx)
+                if bounds or masks:
+                    self.narrowed_loop(
+                        iter_exprs[0], bounds, masks, vector, row, conds
+                    )
+                else:
+                    targets = [self.bind(var_name) for var_name, _ in iter_exprs]
+                    sets = [set_expr for _, set_expr in iter_exprs]
+                    if row is not None:
+                        sets[0] = self.stored_set(sets[0], row, conds)
+                    if len(sets) == 1:
+                        self.emit(f"for {targets[0]} in {self.outer(sets[0])}:")
+                    else:
+                        zipped = self.outer(f"zip({', '.join(sets)})")
+                        self.emit(f"for {', '.join(targets)} in {zipped}:")
+                    self.depth += 1
+                    self.tally("tuples")
+                comps = []
+                for idx in comp_idxs:
+                    if idx not in bounds and idx not in masks:
+                        self.enter(idx)
+                        comps.append(self.op_expr())
+                        self.exit(idx)
+                if comps:
+                    self.emit(f"if not ({' and '.join(comps)}):")
+                    self.depth += 1
+                    self.tally("rejected")
+                    self.emit("continue")
+                    self.depth -= 1
+                level = [self.lines, len(self.lines), self.depth, bool(comp_idxs)]
+                self.levels.append(level)
+                for var_name, local in self.indices.items():
+                    if indices.get(var_name) != local:
+                        self.local_levels[local] = level
             case _:
                 raise CompilerError(
                     f"Expected function block instead found: {self.curr_cursor[0:2]}"
@@ -450,19 +1445,246 @@ class ModelGenerator:
                     f"{' ' * (self.curr_cursor[3].start[1] - 1)}^"
                 )
 
+    def narrowed_loop(self, iter_expr, bounds, masks, vector, row=None, conds=()):
+        # The comparisons in `bounds` are turned into the limits of the range
+        # being iterated and those in `masks` are evaluated over the whole
+        # range at once by `select`, one after the other. They are only
+        # evaluated per element when the set turns out not to be a plain
+        # range of integers.
+        var_name, set_expr = iter_expr
+        values = self.fresh("s")
+        self.emit(f"{values} = {set_expr}")
+        narrowed = None
+        if bounds:
+            narrowed = self.narrow_range(values, bounds)
+            values = f"({values} if {narrowed} is None else {narrowed})"
+        selected = None
+        if masks:
+            selected = self.fresh("m")
+            codes = "".join(f"lambda {vector}: {code}, " for code, _ in masks.values())
+            arrays = dict.fromkeys(a for _, mask in masks.values() for a in mask)
+            self.emit(
+                f"{selected} = select({values}, ({codes})"
+                f"{''.join(f', {array}' for array in arrays)})"
+            )
+            values = f"({values} if {selected} is None else {selected})"
+        target = self.bind(var_name)
+        if row is not None:
+            values = self.stored_set(values, row, conds)
+        values = self.outer(values)
+        self.emit(f"for {target} in {values}:")
+        self.depth += 1
+        self.tally("tuples")
+        for filtered, comp_idxs in [(narrowed, bounds), (selected, masks)]:
+            if filtered is None:
+                continue
+            comps = []
+            for idx in comp_idxs:
+                self.enter(idx)
+                comps.append(self.op_expr())
+                self.exit(idx)
+            self.emit(f"if {filtered} is None and not ({' and '.join(comps)}):")
+            self.depth += 1
+            self.tally("rejected")
+            self.emit("continue")
+            self.depth -= 1
+
+    def stored_set(self, values, row, conds):
+        # Emits the set `values` cut down to the keys stored in `row` and
+        # returns its name. Like the body, `row` is only read for a range
+        # that is not empty once the filters `conds`, which do not depend on
+        # the index, pass.
+        local = self.fresh("s")
+        self.emit(f"{local} = {values}")
+        tests = [f"type({local}) is range", local, *conds]
+        self.emit(f"if {' and '.join(tests)}:")
+        self.depth += 1
+        self.emit(f"{local} = stored({row}, {local})")
+        self.depth -= 1
+        return local
+
+    def narrow_range(self, values, bounds):
+        # Emits the range `values` narrowed to the bounds and returns its name.
+        # `narrow` takes the bounds one by one, so that it sees a NaN among
+        # them, which `max` and `min` may drop.
+        lower = []
+        upper = []
+        for idx, (op, terms) in bounds.items():
+            self.enter(idx)
+            bound = self.bound_expr(terms)
+            self.exit(idx)
+            match op:
+                case "GE" | "EQ":
+                    lower.append(f"ceil_bound({bound})")
+                case "GT":
+                    lower.append(f"floor_bound({bound}) + 1")
+            match op:
+                case "LE" | "EQ":
+                    upper.append(f"floor_bound({bound}) + 1")
+                case "LT":
+                    upper.append(f"ceil_bound({bound})")
+        # The bounds are only evaluated when there is something to narrow,
+        # like the filters they come from.
+        narrowed = self.fresh("r")
+        self.emit(
+            f"{narrowed} = narrow({values}, {self.bound_tuple(lower)},"
+            f" {self.bound_tuple(upper)}) if type({values}) is range and {values}"
+            " else None"
+        )
+        return narrowed
+
+    def vector_expr(self, var_name, vector, arrays):
+        """Return the code of a filter evaluated over all values of an index.
+
+        `vector` is the name of the numpy array of the values of `var_name`.
+        Data subscripted with it is read from the arrays `as_array` converts
+        once per statement, whose names are appended to `arrays`. Returns None
+        for expressions numpy cannot evaluate the same way, such as functions,
+        variables or a division, which may divide by zero.
+        """
+        node = self.curr_cursor
+        if not self.depends_on(node, var_name):
+            return self.op_expr()
+        match node:
+            case ("IDEN", name, [], _) if name == var_name:
+                return vector
+            case ("OP", "PAREN", [("OP", *_)], _):
+                self.enter(0)
+                expr = self.vector_expr(var_name, vector, arrays)
+                self.exit(0)
+                return None if expr is None else f"({expr})"
+            case ("OP", op, [_, _], _) if op in self.binary_op_map and op != "DIV":
+                operands = []
+                for idx in range(2):
+                    self.enter(idx)
+                    operands.append(self.vector_expr(var_name, vector, arrays))
+                    self.exit(idx)
+                if None in operands:
+                    return None
+                return f"({operands[0]} {self.binary_op_map[op]} {operands[1]})"
+            case ("OP", "SLICE", [("IDEN", name, [], _), *subscripts], _) if (
+                name not in self.variables and name not in self.indices
+            ):
+                codes = []
+                for idx in range(1, len(subscripts) + 1):
+                    self.enter(idx)
+                    codes.append(self.vector_expr(var_name, vector, arrays))
+                    self.exit(idx)
+                if None in codes:
+                    return None
+                self.enter(0)
+                self.iden_rhs()
+                self.exit(0)
+                local, ndim = self.arrays.setdefault(
+                    name, (self.fresh("a") + f"_{name}", len(subscripts))
+                )
+                if ndim != len(subscripts):
+                    return None
+                arrays.append(local)
+                return f"{local}[{', '.join(codes)}]"
+        return None
+
+    def outer(self, values):
+        # The outermost loop of a `forall` constraint goes through `gen.split`
+        # so that `ModelGenerator.generate` can hand parts of it to workers.
+        if not self.split:
+            return values
+        self.split = False
+        self.partitioned = True
+        return f"gen.split({values})"
+
+    def bound_tuple(self, bounds):
+        return f"({bounds[0]},)" if len(bounds) == 1 else f"({', '.join(bounds)})"
+
+    def extremum(self, func, bounds):
+        match bounds:
+            case []:
+                return "None"
+            case [bound]:
+                return bound
+            case _:
+                return f"{func}({', '.join(bounds)})"
+
+    def bound_expr(self, terms):
+        parts = []
+        for sign, path in terms:
+            for idx in path:
+                self.enter(idx)
+            code = self.op_expr()
+            for idx in reversed(path):
+                self.exit(idx)
+            parts.append(f"{'+' if sign > 0 else '-'} {code}")
+        if not parts:
+            return "0"
+        return f"({' '.join(parts)})"
+
+    def pushdown(self, comp, var_name):
+        """Rewrite a comparison as `var_name <op> bound`.
+
+        Returns the comparison and the terms of the bound as `(sign, path)`
+        pairs relative to `comp`, or None when `comp` is not linear in
+        `var_name` with a coefficient of one.
+        """
+        match comp:
+            case ("OP", "LT" | "GT" | "LE" | "GE" | "EQ" as op, [lhs, rhs], _):
+                lhs_side = self.linear_side(lhs, var_name, [0])
+                rhs_side = self.linear_side(rhs, var_name, [1])
+                if lhs_side is None or rhs_side is None:
+                    return None
+                lhs_coef, lhs_terms = lhs_side
+                rhs_coef, rhs_terms = rhs_side
+                match lhs_coef - rhs_coef:
+                    case 1:
+                        return op, rhs_terms + [(-s, p) for s, p in lhs_terms]
+                    case -1:
+                        return (
+                            self.comparison_flip_map[op],
+                            lhs_terms + [(-s, p) for s, p in rhs_terms],
+                        )
+        return None
+
+    def linear_side(self, node, var_name, path):
+        if not self.depends_on(node, var_name):
+            return 0, [(1, path)]
+        match node:
+            case ("IDEN", name, [], _) if name == var_name:
+                return 1, []
+            case ("OP", "ADD" | "SUB" as op, [lhs, rhs], _):
+                lhs_side = self.linear_side(lhs, var_name, path + [0])
+                rhs_side = self.linear_side(rhs, var_name, path + [1])
+                if lhs_side is None or rhs_side is None:
+                    return None
+                sign = 1 if op == "ADD" else -1
+                return (
+                    lhs_side[0] + sign * rhs_side[0],
+                    lhs_side[1] + [(sign * s, p) for s, p in rhs_side[1]],
+                )
+            case ("OP", "PAREN", [("OP", *_) as expr], _):
+                return self.linear_side(expr, var_name, path + [0])
+        return None
+
+    def depends_on(self, node, var_name):
+        match node:
+            case ("IDEN", name, _, _):
+                return name == var_name
+            case ("FUNC", *_):
+                return True
+            case (_, _, children, _):
+                return any(self.depends_on(child, var_name) for child in children)
+
+    def iter_expr(self):
+        self.enter(0)
+        var_name = self.iden_lhs()
+        self.exit(0)
+        self.enter(1)
+        set_expr = self.set_expr()
+        self.exit(1)
+        return var_name, set_expr
+
     def set_expr(self):
         match self.curr_cursor:
             case ("IDEN", _, _, _):
-                expr_eval = self.iden_rhs()
-
-                def evaluator(scope):
-                    n = expr_eval(scope)
-                    if isinstance(n, int):
-                        return range(n)
-                    else:
-                        return n
-
-                return evaluator
+                return f"iterate({self.iden_rhs()})"
             case ("OP", "RANGE", _, _):
                 return self.op_expr()
             case _:
@@ -477,132 +1699,1637 @@ class ModelGenerator:
         match self.curr_cursor:
             case ("OP", "RANGE", _, _):
                 self.enter(0)
-                start_expr_eval = self.op_expr()
-                self.exit(0)
-                self.enter(1)
-                end_expr_eval = self.op_expr()
-                self.exit(1)
-
-                def evaluator(scope):
-                    start = start_expr_eval(scope)
-                    end = end_expr_eval(scope)
-                    return range(start, end + 1)
-
-                return evaluator
-            case ("OP", "ITER", _, _):
-                self.enter(0)
-                var_name = self.iden_lhs()
-                self.exit(0)
-                self.enter(1)
-                expr_eval = self.set_expr()
-                self.exit(1)
-
-                def evaluator(scope):
-                    def generator():
-                        for i in expr_eval(scope):
-                            yield {var_name: i}
-
-                    return generator()
-
-                return evaluator
-            case ("OP", "NE", _, _):
-                self.enter(0)
-                lhs = self.op_expr()
-                self.exit(0)
-                self.enter(1)
-                rhs = self.op_expr()
-                self.exit(1)
-                return lambda scope: lhs(scope) != rhs(scope)
-            case ("OP", "EQ", _, _):
-                self.enter(0)
-                lhs = self.op_expr()
-                self.exit(0)
-                self.enter(1)
-                rhs = self.op_expr()
-                self.exit(1)
-                return lambda scope: lhs(scope) == rhs(scope)
-            case ("OP", "LE", _, _):
-                self.enter(0)
-                lhs = self.op_expr()
-                self.exit(0)
-                self.enter(1)
-                rhs = self.op_expr()
-                self.exit(1)
-                return lambda scope: lhs(scope) <= rhs(scope)
-            case ("OP", "GE", _, _):
-                self.enter(0)
-                lhs = self.op_expr()
-                self.exit(0)
-                self.enter(1)
-                rhs = self.op_expr()
-                self.exit(1)
-                return lambda scope: lhs(scope) >= rhs(scope)
-            case ("OP", "LT", _, _):
-                self.enter(0)
-                lhs = self.op_expr()
-                self.exit(0)
-                self.enter(1)
-                rhs = self.op_expr()
-                self.exit(1)
-                return lambda scope: lhs(scope) < rhs(scope)
-            case ("OP", "GT", _, _):
-                self.enter(0)
-                lhs = self.op_expr()
-                self.exit(0)
-                self.enter(1)
-                rhs = self.op_expr()
-                self.exit(1)
-                return lambda scope: lhs(scope) > rhs(scope)
-            case ("OP", "ADD", _, _):
-                self.enter(0)
-                lhs = self.op_expr()
-                self.exit(0)
-                self.enter(1)
-                rhs = self.op_expr()
-                self.exit(1)
-                return lambda scope: lhs(scope) + rhs(scope)
-            case ("OP", "SUB", _, _):
-                self.enter(0)
-                lhs = self.op_expr()
+                start = self.op_expr()
                 self.exit(0)
                 self.enter(1)
-                rhs = self.op_expr()
+                end = self.op_expr()
                 self.exit(1)
-                return lambda scope: lhs(scope) - rhs(scope)
-            case ("OP", "MUL", _, _):
+                return f"range({start}, {end} + 1)"
+            case ("OP", op, _, _) if op in self.binary_op_map:
                 self.enter(0)
                 lhs = self.op_expr()
                 self.exit(0)
                 self.enter(1)
                 rhs = self.op_expr()
                 self.exit(1)
-                return lambda scope: lhs(scope) * rhs(scope)
-            case ("OP", "DIV", _, _):
-                self.enter(0)
-                lhs = self.op_expr()
-                self.exit(0)
-                self.enter(1)
-                rhs = self.op_expr()
-                self.exit(1)
-                return lambda scope: lhs(scope) / rhs(scope)
+                return f"({lhs} {self.binary_op_map[op]} {rhs})"
             case ("OP", "PAREN", _, _):
                 self.enter(0)
-                expr_eval = self.expr()
+                expr = self.expr()
                 self.exit(0)
-                return lambda scope: expr_eval(scope)
+                return f"({expr})"
             case ("OP", "SLICE", children, _):
                 vs = []
                 for idx in range(len(children)):
                     self.enter(idx)
                     vs.append(self.op_expr())
                     self.exit(idx)
+                return vs[0] + "".join(f"[{v}]" for v in vs[1:])
+            case _:
+                return self.base_expr()
+
+
+@functools.lru_cache(maxsize=128)
+def compile_source(source, estimate=False, profile=False, patch=False, write=False):
+    """Return the compiled statements of a program, cached per source.
+
+    With `estimate` the statements count the variables, rows and nonzeros
+    of the model instead of generating it, see `ModelGenerator.estimate`.
+    With `profile` they also record what each loop did, see
+    `ModelGenerator.profile`. With `patch` the constraints only compute the
+    right-hand sides of their rows, see `ModelGenerator.update`. With
+    `write` the objective goes to `gen.objective` as columns and
+    coefficients and only linear statements compile, see `ModelWriter`.
+    """
+    return Compiler(
+        parse_cache.parse(source), estimate, profile, patch, write
+    ).program()
+
+
+class Program(NamedTuple):
+    """A compiled program that models are instantiated from.
+
+    A program holds no model and no data, only the source and its compiled
+    statements. It is immutable, so it can be kept in a long lived cache and
+    instantiated from several threads at once.
+    """
+
+    source: str
+    statements: tuple
+
+    def instantiate(
+        self,
+        model_name,
+        data,
+        names=True,
+        processes=None,
+        parameters=(),
+        presolve=False,
+    ):
+        """Generate a new model from `data` and return its `ModelGenerator`."""
+        gen = ModelGenerator(model_name, self, data, names, parameters, presolve)
+        gen.generate(processes)
+        return gen
+
+    def write(self, path, data, model_name="", chunk=4096, budget=2**22):
+        """Write the model generated from `data` to an LP or MPS file.
+
+        No `mip.Model` is built, see `ModelWriter`. Returns the writer, whose
+        `declared` has the arrays of the program.
+        """
+        gen = ModelWriter(path, model_name, chunk, budget)
+        scope = ChainMap(gen.declared, data)
+        try:
+            for statement in compile_source(self.source, write=True):
+                gen.rows.line = statement_line(statement)
+                statement(gen, scope)
+            gen.close()
+        finally:
+            gen.discard()
+        return gen
+
+
+def compile(source):
+    """Compile a program once so that it can be instantiated many times."""
+    return Program(source, compile_source(source))
+
+
+class NdArray:
+    """N-dimensional array of model variables stored as a flat strided block.
+
+    The variables of an array are consecutive columns of the model, so the
+    array only keeps the first column and the strides. `x[i]` returns a view
+    of the sub-array and subscripting down to a single element returns its
+    `mip.Var`. Indices follow python lists, negative ones count from the end.
+    """
+
+    __slots__ = ("model", "name", "shape", "strides", "offset")
+
+    def __init__(self, model, name, shape, offset, strides=None):
+        self.model = model
+        self.name = name
+        self.shape = shape
+        self.offset = offset
+        if strides is None:
+            strides = []
+            size = 1
+            for n in reversed(shape):
+                strides.append(size)
+                size *= n
+            strides = tuple(reversed(strides))
+        self.strides = strides
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return math.prod(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        n = self.shape[0]
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(f"index {i} is out of range for {self.name}")
+        offset = self.offset + i * self.strides[0]
+        if len(self.shape) == 1:
+            return self.model.vars[offset]
+        return NdArray(self.model, self.name, self.shape[1:], offset, self.strides[1:])
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self[i]
+
+    def __repr__(self):
+        return f"NdArray({self.name!r}, shape={self.shape})"
+
+    def index(self, *idx):
+        """Return the column of the variable at `idx` in the model."""
+        if len(idx) != len(self.shape):
+            raise IndexError(f"{self.name} has {len(self.shape)} dimensions")
+        offset = self.offset
+        for i, n, stride in zip(idx, self.shape, self.strides):
+            if i < 0:
+                i += n
+            if not 0 <= i < n:
+                raise IndexError(f"index {i} is out of range for {self.name}")
+            offset += i * stride
+        return offset
+
+    def var_name(self, *idx):
+        """Return the name `ModelGenerator` gives the variable at `idx`.
+
+        Works whether or not the names were passed to the solver.
+        """
+        return "_".join([self.name, *map(str, idx)])
+
+    def tolist(self):
+        if len(self.shape) == 1:
+            return list(self)
+        return [row.tolist() for row in self]
+
+    @property
+    def x(self):
+        """The values of the variables in the solution, as a numpy array."""
+        return self.values("x")
+
+    @property
+    def rc(self):
+        """The reduced costs of the variables, as a numpy array."""
+        return self.values("rc")
+
+    def values(self, attr):
+        # Only the span of columns the array covers is read from the solver.
+        import numpy
+
+        span = 1 + sum((n - 1) * stride for n, stride in zip(self.shape, self.strides))
+        if 0 in self.shape:
+            span = 0
+        values = column_values(self.model, attr, self.offset, self.offset + span)
+        if values is None:
+            return None
+        flat = numpy.array(values, dtype=float)
+        return numpy.lib.stride_tricks.as_strided(
+            flat, self.shape, [stride * flat.itemsize for stride in self.strides]
+        ).copy()
+
+    def detach(self):
+        """Return a copy without the model, which only supports `index`."""
+        return NdArray(None, self.name, self.shape, self.offset, self.strides)
+
+
+class SparseArray:
+    """Array of model variables that are only created once they are used.
+
+    It indexes like `NdArray`, but an element becomes a column of the model
+    the first time `index` or subscripting reaches it while the model is
+    generated. Once it is, an element that was never used is not added to
+    the model any more: subscripting returns a `mip.LinExpr` fixed at 0 and
+    `index` raises a `KeyError`. `columns` maps the indices of the elements
+    created so far to their columns. It is shared with the views that
+    subscripting returns, which keep the indices leading to them in `prefix`.
+    """
+
+    __slots__ = ("gen", "name", "shape", "var_type", "prefix", "columns")
+
+    def __init__(self, gen, name, shape, var_type, prefix=(), columns=None):
+        self.gen = gen
+        self.name = name
+        self.shape = shape
+        self.var_type = var_type
+        self.prefix = prefix
+        self.columns = {} if columns is None else columns
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return math.prod(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        if len(self.shape) == 1:
+            try:
+                return self.gen.model.vars[self.index(i)]
+            except KeyError:
+                return mip.LinExpr()
+        n = self.shape[0]
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(f"index {i} is out of range for {self.name}")
+        return SparseArray(
+            self.gen,
+            self.name,
+            self.shape[1:],
+            self.var_type,
+            (*self.prefix, i),
+            self.columns,
+        )
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self[i]
+
+    def __repr__(self):
+        return f"SparseArray({self.name!r}, shape={self.shape}, created={len(self.columns)})"
+
+    def index(self, *idx):
+        """Return the column of the variable at `idx`, creating it if needed.
+
+        Raises a `KeyError` for an element that was never used once the model
+        has been generated.
+        """
+        if len(idx) != len(self.shape):
+            raise IndexError(f"{self.name} has {len(self.shape)} dimensions")
+        key = self.prefix + idx
+        col = self.columns.get(key)
+        if col is not None:
+            return col
+        key = list(self.prefix)
+        for i, n in zip(idx, self.shape):
+            if i < 0:
+                i += n
+            if not 0 <= i < n:
+                raise IndexError(f"index {i} is out of range for {self.name}")
+            key.append(i)
+        key = tuple(key)
+        col = self.columns.get(key)
+        if col is None:
+            col = self.gen.add_column(self.var_name(*key), self.var_type)
+            self.columns[key] = col
+        return col
+
+    def var_name(self, *idx):
+        return "_".join([self.name, *map(str, idx)])
+
+    def tolist(self):
+        if len(self.shape) == 1:
+            return list(self)
+        return [row.tolist() for row in self]
+
+    def items(self):
+        """Yield the indices and columns of the elements created so far."""
+        depth = len(self.prefix)
+        for key, col in self.columns.items():
+            if key[:depth] == self.prefix:
+                yield key[depth:], col
+
+    @property
+    def x(self):
+        """The values of the variables in the solution, as a numpy array.
+
+        Elements that were never created are 0.
+        """
+        return self.values("x")
+
+    @property
+    def rc(self):
+        """The reduced costs of the variables, as a numpy array."""
+        return self.values("rc")
+
+    def values(self, attr):
+        import numpy
+
+        items = list(self.items())
+        result = numpy.zeros(self.shape)
+        if not items:
+            return result if self.gen.model.num_solutions else None
+        start = min(col for _, col in items)
+        values = column_values(
+            self.gen.model, attr, start, max(col for _, col in items) + 1
+        )
+        if values is None:
+            return None
+        for idx, col in items:
+            result[idx] = values[col - start]
+        return result
+
+
+def solution_arrays(scope, attr="x"):
+    """Return the declared arrays in `scope` as numpy arrays of `attr`.
+
+    `attr` is "x" for the values of the variables or "rc" for their reduced
+    costs. Arrays without such values in the solver map to None.
+    """
+    return {
+        name: array.values(attr)
+        for name, array in scope.items()
+        if isinstance(array, (NdArray, SparseArray))
+    }
+
+
+def column_values(model, attr, start, stop):
+    """Return `attr` of the columns `start` to `stop` of `model` as a list.
+
+    With CBC the values are copied out of the solver in one call, otherwise
+    they are read variable by variable. Returns None when the solver has no
+    such values, which for reduced costs is the case after solving a MIP.
+    """
+    solver = model.solver
+    cbc = sys.modules.get("mip.cbc")
+    if (
+        cbc is not None
+        and isinstance(solver, cbc.SolverCbc)
+        and (attr == "x" or model.num_int == 0)
+    ):
+        if model.num_solutions == 0:
+            return None
+        if attr == "x":
+            values = cbc.cbclib.Cbc_getColSolution(solver._model)
+        else:
+            values = cbc.cbclib.Cbc_getReducedCost(solver._model)
+        return cbc.ffi.unpack(values + start, stop - start)
+    variables = model.vars
+    if start < stop and getattr(variables[start], attr) is None:
+        return None
+    return [getattr(variables[col], attr) for col in range(start, stop)]
+
+
+def profile_summary(report):
+    """Summarize the report of `ModelGenerator.profile` in one line."""
+    statements = [r for r in report if r["kind"] in ("var", "obj", "constr")]
+    slowest = max(statements, key=lambda r: r["time"])
+    return (
+        f"{sum(r['variables'] for r in statements)} variables,"
+        f" {sum(r['rows'] for r in statements)} rows and"
+        f" {sum(r['terms'] for r in statements)} terms in"
+        f" {sum(r['time'] for r in statements):.3f}s,"
+        f" slowest line {slowest['line']} ({slowest['time']:.3f}s),"
+        f" peak memory {max(r['peak_memory'] for r in statements) / 2**20:.1f} MiB"
+    )
+
+
+def statement_line(statement):
+    return int(statement.__name__.rpartition("_")[2])
+
+
+def array_shape(shape):
+    try:
+        shape = tuple(operator.index(n) for n in shape)
+    except TypeError:
+        raise CompilerError(f"Undefiend array dimension {shape}") from None
+    if not shape or min(shape) < 0:
+        raise CompilerError(f"Undefiend array dimension {list(shape)}")
+    return shape
+
+
+class RowBuffer:
+    """Constraint rows waiting to be loaded into a model, in CSR form.
+
+    The generated code appends the columns and coefficients of a row to
+    `cols` and `vals` and closes it with `end`. Every `chunk` rows the buffer
+    is loaded into the solver, with CBC straight through its C interface.
+    `flush` loads the remaining rows and brings `model.constrs` up to date,
+    `ModelGenerator.generate` calls it once all statements have run.
+    `num_rows` and `num_nonzeros` count what has been loaded so far.
+
+    Without a model the buffer only collects rows, see `take` and `extend`.
+
+    With `presolve` every row is simplified as it is closed, see
+    `presolve_row`, and `presolved` counts what was taken out of the model.
+    `line` is the line of the statement the rows come from, for errors.
+    Rows turned into bounds are counted under "bounds" and the distinct
+    variables this fixed under "fixed".
+    """
+
+    tolerance = 1e-9
+
+    def __init__(self, model, names=True, chunk=4096, presolve=False):
+        self.model = model
+        self.names = names
+        self.chunk = chunk
+        self.presolve = presolve
+        self.line = None
+        self.starts = [0]
+        self.cols = []
+        self.vals = []
+        self.senses = []
+        self.rhs = []
+        self.stale = False
+        self.num_rows = 0
+        self.num_nonzeros = 0
+        self.bounds = {}
+        self.seen = {}
+        self.fixed = set()
+        self.presolved = {"bounds": 0, "fixed": 0, "dropped": 0, "duplicates": 0}
+
+    def end(self, const, sense):
+        """Close the current row as `row + const <sense> 0`."""
+        cols = self.cols
+        start = self.starts[-1]
+        if isinstance(const, mip.Var):
+            const = mip.LinExpr([const], [1])
+        if isinstance(const, mip.LinExpr):
+            cols.extend(var.idx for var in const.expr)
+            self.vals.extend(const.expr.values())
+            const = const.const
+        if len(cols) - start > 1:
+            row = cols[start:]
+            if len(set(row)) != len(row):
+                coefs = dict.fromkeys(row, 0)
+                for col, val in zip(row, self.vals[start:]):
+                    coefs[col] += val
+                cols[start:] = coefs
+                self.vals[start:] = coefs.values()
+        if self.presolve:
+            if not self.presolve_row(sense, -const):
+                return
+        elif len(cols) == start and (self.model is None or self.model.num_cols):
+            # Zero coefficients are left out by the generated code. CBC drops
+            # a row without entries, which would hide a row that cannot hold
+            # and move the rows after it.
+            cols.append(0)
+            self.vals.append(0)
+        self.starts.append(len(cols))
+        self.senses.append(sense)
+        self.rhs.append(-const)
+        if len(self.senses) >= self.chunk:
+            self.load()
+
+    def add_constr(self, expr):
+        if isinstance(expr, mip.LinExpr):
+            self.end(expr, expr.sense)
+        else:
+            # Let `mip` report what is wrong with the constraint.
+            self.flush()
+            self.model.add_constr(expr)
+
+    def take(self):
+        """Remove the buffered rows and return them as a picklable tuple."""
+        block = (self.starts[:], self.cols[:], self.vals[:], self.senses[:], self.rhs[:])
+        del self.starts[1:], self.cols[:], self.vals[:], self.senses[:], self.rhs[:]
+        return block
+
+    def extend(self, block):
+        """Append the rows of a block returned by `take`."""
+        starts, cols, vals, senses, rhs = block
+        if self.presolve:
+            for row, (sense, row_rhs) in enumerate(zip(senses, rhs)):
+                self.cols.extend(cols[starts[row] : starts[row + 1]])
+                self.vals.extend(vals[starts[row] : starts[row + 1]])
+                self.end(-row_rhs, sense)
+            return
+        offset = len(self.cols)
+        self.starts.extend(offset + start for start in starts[1:])
+        self.cols.extend(cols)
+        self.vals.extend(vals)
+        self.senses.extend(senses)
+        self.rhs.extend(rhs)
+        if len(self.senses) >= self.chunk:
+            self.load()
+
+    def load(self):
+        """Load the buffered rows into the solver."""
+        if not self.senses or self.model is None:
+            return
+        model = self.model
+        solver = model.solver
+        starts, cols, vals = self.starts, self.cols, self.vals
+        cbc = sys.modules.get("mip.cbc")
+        if cbc is not None and isinstance(solver, cbc.SolverCbc):
+            ffi = cbc.ffi
+            col_array = ffi.new("int[]", cols)
+            val_array = ffi.new("double[]", vals)
+            add_row = cbc.cbclib.Cbc_addRow
+            cbc_model = solver._model
+            first = solver.num_rows()
+            for row, (sense, rhs) in enumerate(zip(self.senses, self.rhs)):
+                start = starts[row]
+                name = f"constr({first + row})".encode() if self.names else b""
+                add_row(
+                    cbc_model,
+                    name,
+                    starts[row + 1] - start,
+                    col_array + start,
+                    val_array + start,
+                    sense.encode(),
+                    rhs,
+                )
+            self.stale = True
+        else:
+            variables = model.vars
+            for row, (sense, rhs) in enumerate(zip(self.senses, self.rhs)):
+                start, end = starts[row], starts[row + 1]
+                expr = mip.LinExpr(const=-rhs, sense=sense)
+                expr.set_expr(
+                    {
+                        variables[col]: val
+                        for col, val in zip(cols[start:end], vals[start:end])
+                    }
+                )
+                model.add_constr(expr)
+        self.num_rows += len(self.senses)
+        self.num_nonzeros += len(cols)
+        # The lists are cleared in place since the generated code holds on to
+        # `cols` and `vals`.
+        del starts[1:], cols[:], vals[:], self.senses[:], self.rhs[:]
 
-                def evaluator(scope):
-                    x = vs[0](scope)
-                    for i in vs[1:]:
-                        x = x[i(scope)]
-                    return x
+    def flush(self):
+        self.load()
+        if self.stale:
+            self.model.constrs.update_constrs(self.model.solver.num_rows())
+            self.stale = False
+        variables = self.model.vars if self.bounds else None
+        for col, (lower, upper, _) in self.bounds.items():
+            variables[col].lb = lower
+            variables[col].ub = upper
+            if lower == upper:
+                self.fixed.add(col)
+        # A variable can be bounded again after an earlier flush, so it is
+        # counted once by column.
+        self.presolved["fixed"] = len(self.fixed)
+        self.bounds.clear()
 
-                return evaluator
+    def presolve_row(self, sense, rhs):
+        """Simplify the row being closed and return whether it is still needed.
+
+        Zero coefficients are removed. A row without variables is dropped
+        when it holds and a `CompilerError` when it cannot. A row with a
+        single variable becomes a bound of that variable, which `flush`
+        passes to the solver. A row with the same coefficients as an earlier
+        one is merged into it by keeping the tighter right-hand side.
+        """
+        cols, vals = self.cols, self.vals
+        start = self.starts[-1]
+        if 0 in vals[start:]:
+            row = [(col, val) for col, val in zip(cols[start:], vals[start:]) if val]
+            cols[start:] = [col for col, _ in row]
+            vals[start:] = [val for _, val in row]
+        size = len(cols) - start
+        if size == 0:
+            tolerance = self.tolerance
+            if not {
+                mip.LESS_OR_EQUAL: 0 <= rhs + tolerance,
+                mip.GREATER_OR_EQUAL: 0 >= rhs - tolerance,
+                mip.EQUAL: abs(rhs) <= tolerance,
+            }[sense]:
+                raise CompilerError(
+                    f"Constraint on line {self.line} can never hold,"
+                    f" it reduces to 0 {sense}= {rhs}"
+                )
+            self.presolved["dropped"] += 1
+            return False
+        if size == 1:
+            col, val = cols[start], vals[start]
+            del cols[start:], vals[start:]
+            if val < 0:
+                sense = {"<": ">", ">": "<"}.get(sense, sense)
+            bound = rhs / val
+            self.tighten(
+                col,
+                bound if sense in (mip.GREATER_OR_EQUAL, mip.EQUAL) else -mip.INF,
+                bound if sense in (mip.LESS_OR_EQUAL, mip.EQUAL) else mip.INF,
+            )
+            self.presolved["bounds"] += 1
+            return False
+        key = (sense, tuple(cols[start:]), tuple(vals[start:]))
+        row = self.seen.get(key)
+        if row is None:
+            self.seen[key] = self.num_rows + len(self.senses)
+            return True
+        del cols[start:], vals[start:]
+        self.presolved["duplicates"] += 1
+        if row >= self.num_rows:
+            previous = self.rhs[row - self.num_rows]
+        else:
+            previous = self.model.solver.constr_get_rhs(row)
+        match sense:
+            case mip.LESS_OR_EQUAL:
+                merged = min(previous, rhs)
+            case mip.GREATER_OR_EQUAL:
+                merged = max(previous, rhs)
+            case _ if abs(previous - rhs) <= self.tolerance:
+                merged = previous
             case _:
-                return self.base_expr()
+                raise CompilerError(
+                    f"Constraint on line {self.line} can never hold, it equals"
+                    f" the same terms as an earlier one to {rhs} instead of {previous}"
+                )
+        if merged != previous:
+            if row >= self.num_rows:
+                self.rhs[row - self.num_rows] = merged
+            else:
+                self.model.solver.constr_set_rhs(row, merged)
+        return False
+
+    def tighten(self, col, lower, upper):
+        bounds = self.bounds.get(col)
+        if bounds is None:
+            var = self.model.vars[col]
+            bounds = (var.lb, var.ub, var.var_type != mip.CONTINUOUS)
+        previous_lower, previous_upper, integer = bounds
+        if integer:
+            if math.isfinite(lower):
+                lower = math.ceil(lower - self.tolerance)
+            if math.isfinite(upper):
+                upper = math.floor(upper + self.tolerance)
+        lower = max(lower, previous_lower)
+        upper = min(upper, previous_upper)
+        if lower > upper + self.tolerance:
+            raise CompilerError(
+                f"Constraints on line {self.line} leave no value for"
+                f" {self.model.vars[col].name}, its bounds became {lower} and {upper}"
+            )
+        self.bounds[col] = (lower, upper, integer)
+
+
+class ModelGenerator:
+    def __init__(
+        self, model_name, source, locals, names=True, parameters=(), presolve=False
+    ):
+        program = source if isinstance(source, Program) else compile(source)
+        self.model = mip.Model(model_name)
+        self.source = program.source
+        self.statements = program.statements
+        self.locals = locals
+        self.names = names
+        self.rows = RowBuffer(self.model, names, presolve=presolve)
+        self.declared = {}
+        self.parameters = frozenset(parameters)
+        if self.parameters and presolve:
+            # `update` finds the rows of a statement by their position.
+            raise ValueError("parameters cannot be used with presolve")
+        self.values = {}
+        self.row_starts = {}
+        self.generated = False
+        self.streamed = False
+        if self.parameters:
+            for statement in compile_source(self.source, patch=True):
+                for name in sorted(self.parameters & statement.fixed):
+                    line = statement_line(statement)
+                    raise CompilerError(
+                        f"Parameter {name!r} decides the rows on line {line},"
+                        " only right-hand sides and objective coefficients can"
+                        " be parameters"
+                    )
+
+    def ndarray(self, var_name, var_type, shape):
+        shape = array_shape(shape)
+        array = NdArray(self.model, var_name, shape, self.model.num_cols)
+        if self.names:
+            names = (
+                array.var_name(*idx) for idx in itertools.product(*map(range, shape))
+            )
+        else:
+            names = itertools.repeat("", array.size)
+        self.add_vars(names, var_type)
+        return array
+
+    def sparse(self, var_name, var_type, shape):
+        return SparseArray(self, var_name, array_shape(shape), var_type)
+
+    def add_column(self, name, var_type):
+        # Used by `SparseArray`, which creates one variable at a time. Once
+        # the model is generated, and possibly solved, it is left as it is.
+        if self.generated:
+            raise KeyError(f"{name} is not used by the model")
+        return self.model.add_var(name if self.names else "", var_type=var_type).idx
+
+    def add_vars(self, names, var_type):
+        solver = self.model.solver
+        cbc = sys.modules.get("mip.cbc")
+        if cbc is None or not isinstance(solver, cbc.SolverCbc):
+            for name in names:
+                self.model.add_var(name, var_type=var_type)
+            return
+        # Add the columns straight to CBC and create the `mip.Var` objects
+        # once at the end, instead of going through `Model.add_var` per
+        # variable.
+        ub = 1.0 if var_type == mip.BINARY else mip.INF
+        is_int = cbc.CHAR_ZERO if var_type == mip.CONTINUOUS else cbc.CHAR_ONE
+        add_col = cbc.cbclib.Cbc_addCol
+        cbc_model = solver._model
+        null = cbc.ffi.NULL
+        for name in names:
+            add_col(cbc_model, name.encode(), 0.0, ub, 0.0, is_int, 0, null, null)
+        self.model.vars.update_vars(solver.num_cols())
+
+    def split(self, values):
+        return values
+
+    def compiled(self, **mode):
+        """Return the statements compiled in `mode`, see `compile_source`."""
+        if self.streamed:
+            # `stream` drops every statement once it has run.
+            raise ValueError("a model generated by stream keeps no program to run again")
+        return compile_source(self.source, **mode)
+
+    def next_row(self):
+        return self.model.solver.num_rows() + len(self.rows.senses)
+
+    def estimate(self):
+        """Return the size of the model without generating it.
+
+        The program is run in counting mode and one record is returned per
+        statement, with the number of variables, rows and nonzeros it adds.
+        Loops without filters are not enumerated, their length is multiplied
+        instead. Nonzeros are an upper bound: they are counted before the
+        coefficients of a column that appears more than once in a row are
+        added up and include the terms generating leaves out because their
+        coefficient is zero or missing from dict data. They are None for a
+        constraint that is not linear in the variables. The variables of a
+        sparse array are created by the statements that use them, so they
+        are None for its declaration and not counted anywhere else.
+        """
+        sizer = ModelSizer()
+        scope = ChainMap({}, self.locals)
+        records = []
+        for statement in self.compiled(estimate=True):
+            sizer.variables = sizer.rows = sizer.nonzeros = 0
+            statement(sizer, scope)
+            records.append(
+                {
+                    "line": statement_line(statement),
+                    "variables": sizer.variables,
+                    "rows": sizer.rows,
+                    "nonzeros": sizer.nonzeros,
+                }
+            )
+        return records
+
+    def profile(self):
+        """Generate the model like `generate` and report what it cost.
+
+        Returns one record per statement followed by one per `sum` or
+        `forall` in it. Each record has the wall time, the iterations of the
+        loops, the iterations rejected by filters, the terms and rows that
+        were created and the peak memory allocated while it ran, measured
+        with `tracemalloc`. Statement records also have the variables they
+        created. The counts of a statement include its blocks. The program is
+        compiled separately for profiling, so `generate` does not pay for any
+        of it.
+        """
+        self.declared = {}
+        self.generated = False
+        scope = ChainMap(self.declared, self.locals)
+        self.report = []
+        self.peaks = []
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            for idx, statement in enumerate(self.compiled(profile=True)):
+                self.row_starts[idx] = self.next_row()
+                self.rows.line = statement_line(statement)
+                num_cols = self.model.num_cols
+                first = len(self.report)
+                memory = self.enter_site()
+                start = time.perf_counter()
+                statement(self, scope)
+                elapsed = time.perf_counter() - start
+                record = self.report[first]
+                record["time"] = elapsed
+                record["variables"] = self.model.num_cols - num_cols
+                record["peak_memory"] = self.exit_site(memory)
+            self.rows.flush()
+            self.generated = True
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        return self.report
+
+    def enter_site(self):
+        # `tracemalloc` has a single peak, which every site resets when it
+        # starts. `peaks` keeps the peaks of the sites still running, each
+        # one hands its own to the site around it when it ends.
+        memory, peak = tracemalloc.get_traced_memory()
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], peak)
+        tracemalloc.reset_peak()
+        self.peaks.append(memory)
+        return memory
+
+    def exit_site(self, memory):
+        """Return the peak memory allocated since `enter_site` returned `memory`."""
+        peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], peak)
+        tracemalloc.reset_peak()
+        return peak - memory
+
+    def record(self, sites):
+        # Called by the profiled statements with their counters.
+        fields = (
+            "kind",
+            "line",
+            "column",
+            "tuples",
+            "rejected",
+            "terms",
+            "rows",
+            "time",
+            "peak_memory",
+        )
+        records = [dict(zip(fields, site)) for site in sites]
+        for field in ("tuples", "rejected", "terms", "rows"):
+            records[0][field] = sum(record[field] for record in records)
+        self.report.extend(records)
+
+    def generate(self, processes=None):
+        """Run the program and return its scope.
+
+        With `processes` the constraints that only produce linear rows are
+        generated by a pool of worker processes. Each of them is split into
+        `processes` parts along its outermost `forall` loop. The workers
+        return the rows in terms of column indices and the rows are loaded in
+        the order of the program. The names these statements read must then
+        be picklable.
+        """
+        if self.streamed:
+            raise ValueError("a model generated by stream cannot be generated again")
+        # The program only writes the names it declares, so the caller's
+        # namespace is layered underneath instead of being copied.
+        self.declared = {}
+        self.generated = False
+        scope = ChainMap(self.declared, self.locals)
+        if processes is None:
+            for idx, statement in enumerate(self.statements):
+                self.row_starts[idx] = self.next_row()
+                self.rows.line = statement_line(statement)
+                statement(self, scope)
+            self.rows.flush()
+            self.generated = True
+            return scope
+        pending = []
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            for idx, statement in enumerate(self.statements):
+                if not statement.detachable:
+                    self.load_rows(pending)
+                    self.row_starts[idx] = self.next_row()
+                    self.rows.line = statement_line(statement)
+                    statement(self, scope)
+                    continue
+                data = {}
+                for name in statement.globals:
+                    if name in scope:
+                        value = scope[name]
+                        data[name] = (
+                            value.detach() if isinstance(value, NdArray) else value
+                        )
+                # A statement without a `forall` loop is only run by one worker.
+                parts = processes if statement.partitioned else 1
+                pending.extend(
+                    (
+                        idx,
+                        pool.submit(
+                            generate_rows, self.source, idx, data, (part, parts)
+                        ),
+                    )
+                    for part in range(parts)
+                )
+            self.load_rows(pending)
+        self.rows.flush()
+        self.generated = True
+        return scope
+
+    def load_rows(self, pending):
+        for idx, future in pending:
+            self.row_starts.setdefault(idx, self.next_row())
+            self.rows.line = statement_line(self.statements[idx])
+            self.rows.extend(future.result())
+        pending.clear()
+
+    def update(self, values):
+        """Change the values of parameters and patch the model in place.
+
+        Only the statements that read one of `values` are run again, with a
+        `ModelPatcher` in place of the generator. Their constraints set the
+        right-hand sides of the rows `generate` added for them and the
+        objective is set again. Returns the number of rows that changed.
+        """
+        unknown = values.keys() - self.parameters
+        if unknown:
+            raise ValueError(f"{', '.join(sorted(unknown))} are not parameters")
+        self.values.update(values)
+        scope = ChainMap(self.declared, self.values, self.locals)
+        patcher = ModelPatcher(self.model)
+        for idx, statement in enumerate(self.compiled(patch=True)):
+            if values.keys() & set(statement.globals):
+                patcher.row = self.row_starts[idx]
+                statement(patcher, scope)
+        return patcher.changed
+
+    def solution(self):
+        """Return the values of the declared arrays in the current solution.
+
+        The values are keyed by array name as `(shape, values)` with the
+        values flattened in row major order, which is what `warm_start`
+        takes. The values of a sparse array are a dictionary from the indices
+        of the elements created to their values instead. The result is empty
+        when the model has no solution.
+        """
+        if self.model.num_solutions == 0:
+            return {}
+        solution = {}
+        for name, array in self.declared.items():
+            if isinstance(array, NdArray):
+                values = column_values(
+                    self.model, "x", array.offset, array.offset + array.size
+                )
+            elif isinstance(array, SparseArray):
+                values = {
+                    idx: self.model.vars[col].x for idx, col in array.items()
+                }
+            else:
+                continue
+            solution[name] = (array.shape, values)
+        return solution
+
+    def warm_start(self, solution):
+        """Pass a `solution` of an earlier model to the solver as a MIP start.
+
+        Arrays are matched by name and their elements by position, elements
+        outside the shape of either array are left out. Returns the number of
+        variables that were given a start value.
+        """
+        cols = []
+        values = []
+        for name, (shape, previous) in solution.items():
+            array = self.declared.get(name)
+            if not isinstance(array, (NdArray, SparseArray)) or len(shape) != array.ndim:
+                continue
+            if isinstance(previous, dict):
+                items = previous.items()
+            else:
+                common = (range(min(m, n)) for m, n in zip(shape, array.shape))
+                items = (
+                    (idx, previous[NdArray(None, name, shape, 0).index(*idx)])
+                    for idx in itertools.product(*common)
+                )
+            for idx, value in items:
+                if isinstance(array, SparseArray):
+                    # Elements the new model does not use are not created.
+                    col = array.columns.get(idx)
+                elif all(i < n for i, n in zip(idx, array.shape)):
+                    col = array.index(*idx)
+                else:
+                    col = None
+                if col is not None:
+                    cols.append(col)
+                    values.append(value)
+        if not cols:
+            return 0
+        solver = self.model.solver
+        cbc = sys.modules.get("mip.cbc")
+        if cbc is not None and isinstance(solver, cbc.SolverCbc):
+            # CBC matches the start with the columns by name, so a model
+            # generated with `names=False` cannot be started.
+            if not self.names:
+                raise ValueError("a MIP start needs a model with named variables")
+            cbc.cbclib.Cbc_setMIPStartI(
+                solver._model,
+                len(cols),
+                cbc.ffi.new("int[]", cols),
+                cbc.ffi.new("double[]", values),
+            )
+        else:
+            variables = self.model.vars
+            self.model.start = [(variables[col], val) for col, val in zip(cols, values)]
+        return len(cols)
+
+
+class ModelSizer:
+    """Stands in for `ModelGenerator` in `ModelGenerator.estimate`.
+
+    Arrays are created without a model and the statements report their rows
+    and nonzeros through `count`.
+    """
+
+    model = None
+
+    def __init__(self):
+        self.num_cols = 0
+        self.variables = 0
+        self.rows = 0
+        self.nonzeros = 0
+
+    def ndarray(self, var_name, var_type, shape):
+        array = NdArray(None, var_name, array_shape(shape), self.num_cols)
+        self.num_cols += array.size
+        self.variables += array.size
+        return array
+
+    def sparse(self, var_name, var_type, shape):
+        # How many variables a sparse array gets is only known once the
+        # constraints using it are generated.
+        self.variables = None
+        return SparseArray(self, var_name, array_shape(shape), var_type)
+
+    def count(self, rows, nonzeros):
+        self.rows += rows
+        self.nonzeros = None if nonzeros is None else self.nonzeros + nonzeros
+
+
+class RowGenerator:
+    """Stands in for `ModelGenerator` in the worker processes of `generate`.
+
+    There is no model, the statement only fills the row buffer for the part
+    `part` of `parts` of its outermost loop.
+    """
+
+    model = None
+
+    def __init__(self, part, parts):
+        self.part = part
+        self.parts = parts
+        self.rows = RowBuffer(None, chunk=math.inf)
+
+    def split(self, values):
+        values = list(values)
+        n = len(values)
+        return values[self.part * n // self.parts : (self.part + 1) * n // self.parts]
+
+
+class ModelPatcher:
+    """Stands in for `ModelGenerator` in `ModelGenerator.update`.
+
+    The constraints run in the same order as when the model was generated,
+    so every `patch` refers to the next row of the model, starting at `row`.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.rows = self
+        self.row = 0
+        self.changed = 0
+
+    def split(self, values):
+        return values
+
+    def patch(self, const):
+        solver = self.model.solver
+        if solver.constr_get_rhs(self.row) != -const:
+            solver.constr_set_rhs(self.row, -const)
+            self.changed += 1
+        self.row += 1
+
+
+class RowWriter(RowBuffer):
+    """A `RowBuffer` that hands its chunks of rows to a `ModelWriter`."""
+
+    def __init__(self, writer, chunk=4096):
+        super().__init__(None, chunk=chunk)
+        self.writer = writer
+
+    def load(self):
+        if not self.senses:
+            return
+        self.writer.write_rows(
+            self.num_rows, self.starts, self.cols, self.vals, self.senses, self.rhs
+        )
+        self.num_rows += len(self.senses)
+        self.num_nonzeros += len(self.cols)
+        del self.starts[1:], self.cols[:], self.vals[:], self.senses[:], self.rhs[:]
+
+    def flush(self):
+        self.load()
+
+
+class ModelWriter:
+    """Stands in for `ModelGenerator` in `Program.write`.
+
+    The model goes to a file instead of a `mip.Model`. The format follows
+    the extension of `path`, `.lp` or `.mps` (free MPS), which may be
+    followed by `.gz`, `.bz2` or `.xz` to compress the file. Every `chunk`
+    rows the buffered rows are written to temporary files next to `path`
+    and `close` puts the file together, so memory only grows with the
+    columns. MPS lists the coefficients by column, they are read back from
+    the temporary file in as many passes over it as it takes to keep at
+    most `budget` of them in memory.
+
+    Variables and rows are named as `ModelGenerator` names them and the
+    objective row is `obj`. In MPS a maximized objective is written as the
+    minimization of its negation.
+    """
+
+    model = None
+    openers = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+    sense_map = {
+        mip.LESS_OR_EQUAL: ("L", "<="),
+        mip.GREATER_OR_EQUAL: ("G", ">="),
+        mip.EQUAL: ("E", "="),
+    }
+
+    def __init__(self, path, model_name="", chunk=4096, budget=2**22):
+        root, ext = os.path.splitext(path)
+        self.opener = self.openers.get(ext, open)
+        if ext in self.openers:
+            ext = os.path.splitext(root)[1]
+        if ext not in (".lp", ".mps"):
+            raise ValueError(f"Cannot tell the format of {path}, expected .lp or .mps")
+        self.path = path
+        self.format = ext[1:]
+        self.model_name = model_name
+        self.budget = budget
+        self.declared = {}
+        self.rows = RowWriter(self, chunk)
+        self.num_cols = 0
+        self.offsets = []
+        self.arrays = []
+        self.columns = {}
+        self.sense = "MIN"
+        self.costs = {}
+        self.const = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        self.spools = [tempfile.TemporaryFile("w+", dir=directory)]
+        if self.format == "mps":
+            # The RHS section and the coefficients, as triplets.
+            self.spools.append(tempfile.TemporaryFile("w+", dir=directory))
+            self.spools.append(tempfile.TemporaryFile("w+b", dir=directory))
+            self.counts = array.array("q")
+
+    def ndarray(self, var_name, var_type, shape):
+        array = NdArray(None, var_name, array_shape(shape), self.num_cols)
+        self.offsets.append(self.num_cols)
+        self.arrays.append((array, var_type))
+        self.num_cols += array.size
+        return array
+
+    def sparse(self, var_name, var_type, shape):
+        return SparseArray(self, var_name, array_shape(shape), var_type)
+
+    def add_column(self, name, var_type):
+        self.columns[self.num_cols] = (name, var_type)
+        self.num_cols += 1
+        return self.num_cols - 1
+
+    def split(self, values):
+        return values
+
+    def objective(self, sense, cols, vals, const):
+        self.sense = sense
+        self.costs = dict.fromkeys(cols, 0)
+        for col, val in zip(cols, vals):
+            self.costs[col] += val
+        self.const = const
+
+    def column(self, col):
+        """Return the name and type of the column `col`."""
+        if col in self.columns:
+            return self.columns[col]
+        array, var_type = self.arrays[bisect.bisect_right(self.offsets, col) - 1]
+        idx = []
+        rest = col - array.offset
+        for stride in array.strides:
+            i, rest = divmod(rest, stride)
+            idx.append(i)
+        return array.var_name(*idx), var_type
+
+    def write_rows(self, first, starts, cols, vals, senses, rhs):
+        """Write rows `first` onwards to the temporary files."""
+        if self.format == "lp":
+            spool = self.spools[0]
+            for row, (sense, row_rhs) in enumerate(zip(senses, rhs)):
+                start, end = starts[row], starts[row + 1]
+                terms = zip(cols[start:end], vals[start:end])
+                spool.write(f" constr({first + row}):")
+                self.write_terms(spool, terms)
+                spool.write(f" {self.sense_map[sense][1]} {float(row_rhs)!r}\n")
+            return
+        rows, rhs_spool, triplets = self.spools
+        counts = self.counts
+        if len(counts) < self.num_cols:
+            counts.extend(itertools.repeat(0, self.num_cols - len(counts)))
+        row_idx = array.array("q")
+        for row, (sense, row_rhs) in enumerate(zip(senses, rhs)):
+            rows.write(f" {self.sense_map[sense][0]}  constr({first + row})\n")
+            if row_rhs:
+                rhs_spool.write(f"    RHS constr({first + row}) {float(row_rhs)!r}\n")
+            row_idx.extend(itertools.repeat(first + row, starts[row + 1] - starts[row]))
+        for col in cols:
+            counts[col] += 1
+        triplets.write(array.array("q", [len(cols)]).tobytes())
+        triplets.write(array.array("q", cols).tobytes())
+        triplets.write(row_idx.tobytes())
+        triplets.write(array.array("d", vals).tobytes())
+
+    def write_terms(self, file, terms):
+        # LP files are read line by line, long rows are wrapped.
+        width = 0
+        for col, val in terms:
+            name = self.column(col)[0]
+            term = f" {'-' if val < 0 else '+'} {abs(float(val))!r} {name}"
+            width += len(term)
+            if width > 255:
+                file.write("\n")
+                width = len(term)
+            file.write(term)
+
+    def close(self):
+        """Write the file from the temporary files."""
+        self.rows.flush()
+        with self.opener(self.path, "wt") as file:
+            if self.format == "lp":
+                self.write_lp(file)
+            else:
+                self.write_mps(file)
+
+    def discard(self):
+        for spool in self.spools:
+            spool.close()
+
+    def write_lp(self, file):
+        file.write(f"\\Problem name: {self.model_name}\n\n")
+        file.write("Maximize\n" if self.sense == "MAX" else "Minimize\n")
+        file.write(" obj:")
+        # Readers number the columns of an LP file in the order they first
+        # appear, every column is listed so that they keep their order.
+        self.write_terms(
+            file, ((col, self.costs.get(col, 0)) for col in range(self.num_cols))
+        )
+        if self.const:
+            file.write(f" {'-' if self.const < 0 else '+'} {abs(float(self.const))!r}")
+        file.write("\nSubject To\n")
+        spool = self.spools[0]
+        spool.seek(0)
+        shutil.copyfileobj(spool, file)
+        sections = {mip.INTEGER: [], mip.BINARY: []}
+        for col in range(self.num_cols):
+            name, var_type = self.column(col)
+            if var_type in sections:
+                sections[var_type].append(name)
+        for title, var_type in (("Generals", mip.INTEGER), ("Binaries", mip.BINARY)):
+            names = sections[var_type]
+            if names:
+                file.write(f"{title}\n")
+                for i in range(0, len(names), 10):
+                    file.write(f" {' '.join(names[i : i + 10])}\n")
+        file.write("End\n")
+
+    def write_mps(self, file):
+        rows, rhs_spool, triplets = self.spools
+        file.write(f"NAME {self.model_name}\n")
+        # CBC ignores an OBJSENSE section, so instead of declaring MAX the
+        # objective is negated, which every reader minimizes the same way.
+        sign = -1 if self.sense == "MAX" else 1
+        file.write("ROWS\n N  obj\n")
+        rows.seek(0)
+        shutil.copyfileobj(rows, file)
+        file.write("COLUMNS\n")
+        counts = self.counts
+        counts.extend(itertools.repeat(0, self.num_cols - len(counts)))
+        start = 0
+        while start < self.num_cols:
+            # The columns `start` to `stop` take one pass over the triplets.
+            stop = start + 1
+            size = counts[start]
+            while stop < self.num_cols and size + counts[stop] <= self.budget:
+                size += counts[stop]
+                stop += 1
+            # The coefficients are sorted by column into flat arrays, where
+            # `ends` moves to the end of each column as it fills up.
+            ends = array.array("q", itertools.accumulate(counts[start:stop], initial=0))
+            entry_rows = array.array("q", bytes(8 * size))
+            entry_vals = array.array("d", bytes(8 * size))
+            triplets.seek(0)
+            while header := triplets.read(8):
+                n = array.array("q", header)[0]
+                cols = array.array("q", triplets.read(8 * n))
+                row_idx = array.array("q", triplets.read(8 * n))
+                vals = array.array("d", triplets.read(8 * n))
+                for col, row, val in zip(cols, row_idx, vals):
+                    if start <= col < stop:
+                        pos = ends[col - start]
+                        entry_rows[pos] = row
+                        entry_vals[pos] = val
+                        ends[col - start] = pos + 1
+            begin = 0
+            for col in range(start, stop):
+                name = self.column(col)[0]
+                cost = sign * self.costs.get(col, 0)
+                end = ends[col - start]
+                if cost or begin == end:
+                    file.write(f"    {name} obj {float(cost)!r}\n")
+                for row, val in zip(entry_rows[begin:end], entry_vals[begin:end]):
+                    file.write(f"    {name} constr({row}) {val!r}\n")
+                begin = end
+            start = stop
+        file.write("RHS\n")
+        if self.const:
+            file.write(f"    RHS obj {-float(sign * self.const)!r}\n")
+        rhs_spool.seek(0)
+        shutil.copyfileobj(rhs_spool, file)
+        file.write("BOUNDS\n")
+        for col in range(self.num_cols):
+            name, var_type = self.column(col)
+            if var_type == mip.BINARY:
+                file.write(f" BV BND {name}\n")
+            elif var_type == mip.INTEGER:
+                file.write(f" UI BND {name} 1e+30\n")
+        file.write("ENDATA\n")
+
+
+def stream(model_name, source, locals, names=True, presolve=False, ahead=2):
+    """Generate a model from a program parsed and run one statement at a time.
+
+    `source` is the text of the program, an open file or any iterable of
+    its lines. Every statement is compiled and run as soon as it is parsed,
+    its rows go to the model in chunks as usual and its syntax tree and code
+    are dropped once it has run, so a program of thousands of lines never
+    sits in memory as a whole. With `ahead` a thread parses up to that many
+    statements ahead while the current one runs. Returns the
+    `ModelGenerator` of the model, whose `declared` has the arrays. Since it
+    keeps no program, its `generate`, `estimate`, `profile` and `update`
+    raise a `ValueError`.
+    """
+    if isinstance(source, str):
+        readline = io.StringIO(source).readline
+    elif hasattr(source, "readline"):
+        readline = source.readline
+    else:
+        readline = functools.partial(next, iter(source), "")
+    gen = ModelGenerator(model_name, Program("", ()), locals, names, presolve=presolve)
+    compiler = Compiler(None)
+    scope = ChainMap(gen.declared, locals)
+    statements = parse_statements(readline)
+    if ahead:
+        statements = prefetch(statements, ahead)
+    try:
+        for idx, node in enumerate(statements):
+            statement = compiler.feed(node)
+            gen.row_starts[idx] = gen.next_row()
+            gen.rows.line = statement_line(statement)
+            statement(gen, scope)
+            linecache.cache.pop(statement.__code__.co_filename, None)
+    finally:
+        statements.close()
+    gen.rows.flush()
+    gen.generated = True
+    gen.streamed = True
+    return gen
+
+
+def prefetch(iterable, size):
+    """Yield the items of `iterable` while a thread gets up to `size` more."""
+    items = queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except BaseException as error:
+            put((False, error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            more, item = items.get()
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def generate_rows(source, idx, data, part):
+    """Run statement `idx` of a program for one part and return its rows."""
+    gen = RowGenerator(*part)
+    compile_source(source)[idx](gen, data)
+    return gen.rows.take()
+
+
+def unflatten(shape, values):
+    """Return the row major `values` of an array of `shape` as nested lists.
+
+    `values` can also be a dictionary from indices to values as returned for
+    sparse arrays by `ModelGenerator.solution`, missing elements are 0.
+    """
+    if isinstance(values, dict):
+        flat = [0.0] * math.prod(shape)
+        array = NdArray(None, None, shape, 0)
+        for idx, value in values.items():
+            flat[array.index(*idx)] = value
+        values = flat
+    for n in reversed(shape[1:]):
+        values = [values[i : i + n] for i in range(0, len(values), n)]
+    return values
+
+
+class BackgroundSolve:
+    """Generates and solves a model in a separate process.
+
+    The handle returns at once. While the solver runs `bound`, `incumbent`
+    and `gap` follow its progress, as far as the solver reports it. `status`
+    is "running" until the name of the final `mip.OptimizationStatus`,
+    "cancelled" or "failed". Then `objective_value`, `solution` (see
+    `ModelGenerator.solution`) and `scope`, the values of the declared arrays
+    as nested lists, are set and `on_done` is called with the handle.
+
+    The model itself stays in the worker process, which is what makes
+    `cancel` possible at any time. Only the names the program reads are
+    sent to it, so those must be picklable.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        source,
+        locals,
+        names=True,
+        max_seconds=mip.INF,
+        start=None,
+        on_done=None,
+        presolve=False,
+    ):
+        program = source if isinstance(source, Program) else compile(source)
+        self.model_name = model_name
+        self.on_done = on_done
+        self.status = "running"
+        self.bound = self.incumbent = self.gap = None
+        self.objective_value = None
+        self.solution = None
+        self.scope = None
+        self.error = None
+        self.started = time.perf_counter()
+        self.elapsed = None
+        self.finished = threading.Event()
+        data = {
+            name: locals[name]
+            for statement in program.statements
+            for name in statement.globals
+            if name in locals
+        }
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=solve_model,
+            args=(
+                sender,
+                model_name,
+                program.source,
+                data,
+                names,
+                max_seconds,
+                start,
+                presolve,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        sender.close()
+        self.listener = threading.Thread(target=self.listen, args=(receiver,), daemon=True)
+        self.listener.start()
+
+    def listen(self, receiver):
+        status = "failed"
+        try:
+            while True:
+                message = receiver.recv()
+                match message:
+                    case ("progress", bound, incumbent):
+                        self.progress(bound, incumbent)
+                    case ("done", status, objective_value, bound, solution):
+                        self.objective_value = objective_value
+                        self.solution = solution
+                        self.scope = {
+                            name: unflatten(shape, values)
+                            for name, (shape, values) in solution.items()
+                        }
+                        self.progress(bound, objective_value)
+                        break
+                    case ("failed", error):
+                        self.error = error
+                        break
+        except EOFError:
+            if self.status == "cancelling":
+                status = "cancelled"
+        finally:
+            receiver.close()
+            self.process.join()
+            self.elapsed = time.perf_counter() - self.started
+            self.status = status
+            try:
+                if self.on_done is not None:
+                    self.on_done(self)
+            finally:
+                self.finished.set()
+
+    def progress(self, bound, incumbent):
+        if bound is not None:
+            self.bound = bound
+        if incumbent is not None:
+            self.incumbent = incumbent
+        if self.bound is not None and self.incumbent is not None:
+            self.gap = abs(self.incumbent - self.bound) / max(abs(self.incumbent), 1e-10)
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the solve to finish and return whether it did."""
+        return self.finished.wait(timeout)
+
+    def cancel(self):
+        """Stop the worker process, the model and its solution are lost."""
+        if not self.done():
+            self.status = "cancelling"
+            self.process.terminate()
+
+    def __repr__(self):
+        elapsed = self.elapsed or time.perf_counter() - self.started
+        return (
+            f"BackgroundSolve({self.model_name!r}, status={self.status!r},"
+            f" incumbent={self.incumbent}, bound={self.bound}, gap={self.gap},"
+            f" elapsed={elapsed:.1f}s)"
+        )
+
+
+def solve_model(
+    connection, model_name, source, data, names, max_seconds, start, presolve
+):
+    """Generate and solve a model, reporting to `BackgroundSolve`."""
+    try:
+        gen = ModelGenerator(model_name, source, data, names, presolve=presolve)
+        gen.generate()
+        if start:
+            gen.warm_start(start)
+        model = gen.model
+        solver = model.solver
+        cbc = sys.modules.get("mip.cbc")
+        if cbc is not None and isinstance(solver, cbc.SolverCbc):
+            maximize = model.sense == mip.MAXIMIZE
+
+            @cbc.ffi.callback(
+                "int (void *, int, int, const char *, double, double, double,"
+                " int, int *, void *)"
+            )
+            def progress(model, phase, step, phase_name, seconds, lb, ub, *_):
+                # The incumbent is in the sense of the objective, but during
+                # branch and bound CBC reports the bound of the minimization
+                # it solves.
+                if maximize and phase_name != cbc.ffi.NULL and cbc.ffi.string(
+                    phase_name
+                ) in (b"sol", b"bnd"):
+                    lb = -lb
+                connection.send(
+                    (
+                        "progress",
+                        lb if abs(lb) < sys.float_info.max else None,
+                        ub if abs(ub) < sys.float_info.max else None,
+                    )
+                )
+                return -1
+
+            cbc.cbclib.Cbc_addProgrCallback(solver._model, progress, cbc.ffi.NULL)
+        status = model.optimize(max_seconds=max_seconds)
+        # `Model.objective_bound` has the same problem as the progress of
+        # CBC, so the bound of an unfinished search is the last one reported.
+        optimal = status == mip.OptimizationStatus.OPTIMAL
+        connection.send(
+            (
+                "done",
+                status.name,
+                model.objective_value,
+                model.objective_value if optimal else None,
+                gen.solution(),
+            )
+        )
+    except Exception:
+        connection.send(("failed", traceback.format_exc()))
+    finally:
+        connection.close()
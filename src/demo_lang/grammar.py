@@ -0,0 +1,37 @@
+import io
+import os
+import sys
+import tokenize
+
+grammar_file = os.path.join(os.path.dirname(__file__), "grammar.gram")
+parser_file = os.path.join(os.path.dirname(__file__), "parser.py")
+
+
+def generate_parser():
+    """Return the source of the pegen parser generated from `grammar.gram`.
+
+    Only this function needs pegen's grammar machinery. The package ships the
+    result as `demo_lang.parser` so that `demo_lang.compile.parse` never has to
+    analyse the grammar at runtime.
+    """
+    from pegen.grammar_parser import GeneratedParser as GrammarParser
+    from pegen.python_generator import PythonParserGenerator
+    from pegen.tokenizer import Tokenizer
+
+    with open(grammar_file) as file:
+        tokenizer = Tokenizer(tokenize.generate_tokens(file.readline))
+        grammar = GrammarParser(tokenizer).start()
+    if not grammar:
+        raise SyntaxError(f"Invalid grammar in {grammar_file}")
+    out = io.StringIO()
+    PythonParserGenerator(grammar, out).generate(os.path.basename(grammar_file))
+    return out.getvalue()
+
+
+def write_parser(path=parser_file):
+    with open(path, "w") as f:
+        f.write(generate_parser())
+
+
+if __name__ == "__main__":
+    write_parser(*sys.argv[1:])
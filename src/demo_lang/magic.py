@@ -1,17 +1,98 @@
+from IPython.core.error import UsageError
 from IPython.core.magic import Magics, magics_class, cell_magic
-from .compile import ModelGenerator
+from IPython.core.magic_arguments import argument, magic_arguments, parse_argstring
+import mip
+
+from .compile import BackgroundSolve, ModelGenerator, parse_cache, profile_summary
 
 
 @magics_class
 class DemoMagics(Magics):
 
+    def __init__(self, shell):
+        super().__init__(shell)
+        # The last solution of every model, keyed by the name of the model or,
+        # for cells without a name, by their source.
+        self.solutions = {}
+
+    @magic_arguments()
+    @argument(
+        "--estimate",
+        action="store_true",
+        help="Return the size of the model per statement without generating it.",
+    )
+    @argument(
+        "--profile",
+        action="store_true",
+        help="Return the cost of generating each statement without solving.",
+    )
+    @argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Generate the constraints with a pool of this many processes.",
+    )
+    @argument(
+        "--presolve",
+        action="store_true",
+        help="Turn single variable rows into bounds and merge duplicate rows.",
+    )
+    @argument(
+        "--cold",
+        action="store_true",
+        help="Do not start the solver from the solution of the previous run.",
+    )
+    @argument(
+        "--background",
+        action="store_true",
+        help="Solve in a worker process and return a handle to the solve at once.",
+    )
+    @argument(
+        "--time-limit",
+        type=float,
+        default=mip.INF,
+        help="Stop the solver after this many seconds.",
+    )
+    @argument("name", nargs="*", help="Name of the model.")
     @cell_magic
     def demo(self, line, cell):
-        model_name = line.strip()
+        args = parse_argstring(self.demo, line)
+        model_name = " ".join(args.name)
         source = cell.strip()
         ns = self.shell.user_ns
-        gen = ModelGenerator(model_name, source, ns)
-        scope = gen.generate()
-        gen.model.optimize()
-        ns.update(scope)
+        key = model_name or parse_cache.digest(source)
+        start = None if args.cold else self.solutions.get(key)
+        if args.background and not (args.estimate or args.profile):
+            # The worker process cannot start a pool of its own.
+            if args.processes is not None:
+                raise UsageError("--processes cannot be used with --background")
+
+            def publish(solve):
+                if solve.scope is not None:
+                    ns.update(solve.scope)
+                    self.solutions[key] = solve.solution
+
+            return BackgroundSolve(
+                model_name,
+                source,
+                ns,
+                max_seconds=args.time_limit,
+                start=start,
+                on_done=publish,
+                presolve=args.presolve,
+            )
+        gen = ModelGenerator(model_name, source, ns, presolve=args.presolve)
+        if args.estimate:
+            return gen.estimate()
+        if args.profile:
+            report = gen.profile()
+            print(profile_summary(report))
+            ns.update(gen.declared)
+            return report
+        gen.generate(args.processes)
+        if start:
+            gen.warm_start(start)
+        gen.model.optimize(max_seconds=args.time_limit)
+        self.solutions[key] = gen.solution()
+        ns.update(gen.declared)
         return gen.model
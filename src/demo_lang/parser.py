@@ -0,0 +1,621 @@
+#!/usr/bin/env python3.8
+# @generated by pegen from grammar.gram
+
+import ast
+import sys
+import tokenize
+
+from typing import Any, Optional
+
+from pegen.parser import memoize, memoize_left_rec, logger, Parser
+# Keywords and soft keywords are listed at the end of the parser definition.
+class GeneratedParser(Parser):
+
+    @memoize
+    def start(self) -> Optional[Any]:
+        # start: root
+        mark = self._mark()
+        if (
+            (root := self.root())
+        ):
+            return ( 'ROOT' , None , tuple ( root ) );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def root(self) -> Optional[Any]:
+        # root: NEWLINE.statement+
+        mark = self._mark()
+        if (
+            (_gather_1 := self._gather_1())
+        ):
+            return _gather_1;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def statement(self) -> Optional[Any]:
+        # statement: var_statement | obj_statement | constr_statement
+        mark = self._mark()
+        if (
+            (var_statement := self.var_statement())
+        ):
+            return var_statement;
+        self._reset(mark)
+        if (
+            (obj_statement := self.obj_statement())
+        ):
+            return obj_statement;
+        self._reset(mark)
+        if (
+            (constr_statement := self.constr_statement())
+        ):
+            return constr_statement;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def var_statement(self) -> Optional[Any]:
+        # var_statement: 'var' var_type iden '=' var_expr
+        mark = self._mark()
+        if (
+            (tk := self.expect('var'))
+            and
+            (var_type := self.var_type())
+            and
+            (lhs := self.iden())
+            and
+            (self.expect('='))
+            and
+            (rhs := self.var_expr())
+        ):
+            return ( 'VAR' , var_type , ( lhs , rhs ) , tk );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def var_type(self) -> Optional[Any]:
+        # var_type: 'cont' | 'int' | 'bin'
+        mark = self._mark()
+        if (
+            (self.expect('cont'))
+        ):
+            return 'CONT';
+        self._reset(mark)
+        if (
+            (self.expect('int'))
+        ):
+            return 'INT';
+        self._reset(mark)
+        if (
+            (self.expect('bin'))
+        ):
+            return 'BIN';
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def var_expr(self) -> Optional[Any]:
+        # var_expr: 'ndarray' '(' shape ')' | "sparse" '(' shape ')'
+        mark = self._mark()
+        if (
+            (tk := self.expect('ndarray'))
+            and
+            (self.expect('('))
+            and
+            (shape := self.shape())
+            and
+            (self.expect(')'))
+        ):
+            return ( 'FUNC' , 'NDARRAY' , tuple ( shape ) , tk );
+        self._reset(mark)
+        if (
+            (tk := self.expect("sparse"))
+            and
+            (self.expect('('))
+            and
+            (shape := self.shape())
+            and
+            (self.expect(')'))
+        ):
+            return ( 'FUNC' , 'SPARSE' , tuple ( shape ) , tk );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def shape(self) -> Optional[Any]:
+        # shape: ','.base_expr+
+        mark = self._mark()
+        if (
+            (_gather_3 := self._gather_3())
+        ):
+            return _gather_3;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def constr_statement(self) -> Optional[Any]:
+        # constr_statement: 'constr' expr
+        mark = self._mark()
+        if (
+            (tk := self.expect('constr'))
+            and
+            (expr := self.expr())
+        ):
+            return ( 'CONSTR' , None , ( expr , ) , tk );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def obj_statement(self) -> Optional[Any]:
+        # obj_statement: 'obj' obj_func expr
+        mark = self._mark()
+        if (
+            (tk := self.expect('obj'))
+            and
+            (obj_func := self.obj_func())
+            and
+            (expr := self.expr())
+        ):
+            return ( 'OBJ' , obj_func , ( expr , ) , tk );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def obj_func(self) -> Optional[Any]:
+        # obj_func: 'min' | 'max'
+        mark = self._mark()
+        if (
+            (self.expect('min'))
+        ):
+            return 'MIN';
+        self._reset(mark)
+        if (
+            (self.expect('max'))
+        ):
+            return 'MAX';
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def expr(self) -> Optional[Any]:
+        # expr: func_expr | comp_op_expr
+        mark = self._mark()
+        if (
+            (func_expr := self.func_expr())
+        ):
+            return func_expr;
+        self._reset(mark)
+        if (
+            (comp_op_expr := self.comp_op_expr())
+        ):
+            return comp_op_expr;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def func_expr(self) -> Optional[Any]:
+        # func_expr: func_iden block+ expr
+        mark = self._mark()
+        if (
+            (func := self.func_iden())
+            and
+            (b := self._loop1_5())
+            and
+            (e := self.expr())
+        ):
+            return ( func [0] , func [1] , ( e , * b ) , func [2] );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def block(self) -> Optional[Any]:
+        # block: '(' ','.iter_expr+ rest* ')'
+        mark = self._mark()
+        if (
+            (tk := self.expect('('))
+            and
+            (it := self._gather_6())
+            and
+            (re := self._loop0_8(),)
+            and
+            (self.expect(')'))
+        ):
+            return ( 'BLOCK' , None , ( * it , * re ) , tk );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def rest(self) -> Optional[Any]:
+        # rest: ',' comp_op_expr
+        mark = self._mark()
+        if (
+            (self.expect(','))
+            and
+            (comp_op_expr := self.comp_op_expr())
+        ):
+            return comp_op_expr;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def func_iden(self) -> Optional[Any]:
+        # func_iden: 'sum' | 'forall'
+        mark = self._mark()
+        if (
+            (tk := self.expect('sum'))
+        ):
+            return ( 'FUNC' , 'SUM' , tk );
+        self._reset(mark)
+        if (
+            (tk := self.expect('forall'))
+        ):
+            return ( 'FUNC' , 'FORALL' , tk );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def iter_expr(self) -> Optional[Any]:
+        # iter_expr: iden ':=' set_expr
+        mark = self._mark()
+        if (
+            (lhs := self.iden())
+            and
+            (tk := self.expect(':='))
+            and
+            (rhs := self.set_expr())
+        ):
+            return ( 'OP' , 'ITER' , ( lhs , rhs ) , tk );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def set_expr(self) -> Optional[Any]:
+        # set_expr: add_sub_op_expr ':' add_sub_op_expr | iden
+        mark = self._mark()
+        if (
+            (lhs := self.add_sub_op_expr())
+            and
+            (tk := self.expect(':'))
+            and
+            (rhs := self.add_sub_op_expr())
+        ):
+            return ( 'OP' , 'RANGE' , ( lhs , rhs ) , tk );
+        self._reset(mark)
+        if (
+            (iden := self.iden())
+        ):
+            return iden;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def comp_op_expr(self) -> Optional[Any]:
+        # comp_op_expr: add_sub_op_expr comp_op add_sub_op_expr | add_sub_op_expr
+        mark = self._mark()
+        if (
+            (lhs := self.add_sub_op_expr())
+            and
+            (comp_op := self.comp_op())
+            and
+            (rhs := self.add_sub_op_expr())
+        ):
+            return ( comp_op [0] , comp_op [1] , ( lhs , rhs ) , comp_op [2] );
+        self._reset(mark)
+        if (
+            (add_sub_op_expr := self.add_sub_op_expr())
+        ):
+            return add_sub_op_expr;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def comp_op(self) -> Optional[Any]:
+        # comp_op: '!=' | '==' | '<=' | '>=' | '<' | '>'
+        mark = self._mark()
+        if (
+            (tk := self.expect('!='))
+        ):
+            return ( 'OP' , 'NE' , tk );
+        self._reset(mark)
+        if (
+            (tk := self.expect('=='))
+        ):
+            return ( 'OP' , 'EQ' , tk );
+        self._reset(mark)
+        if (
+            (tk := self.expect('<='))
+        ):
+            return ( 'OP' , 'LE' , tk );
+        self._reset(mark)
+        if (
+            (tk := self.expect('>='))
+        ):
+            return ( 'OP' , 'GE' , tk );
+        self._reset(mark)
+        if (
+            (tk := self.expect('<'))
+        ):
+            return ( 'OP' , 'LT' , tk );
+        self._reset(mark)
+        if (
+            (tk := self.expect('>'))
+        ):
+            return ( 'OP' , 'GT' , tk );
+        self._reset(mark)
+        return None;
+
+    @memoize_left_rec
+    def add_sub_op_expr(self) -> Optional[Any]:
+        # add_sub_op_expr: add_sub_op_expr '+' mul_div_op_expr | add_sub_op_expr '-' mul_div_op_expr | mul_div_op_expr
+        mark = self._mark()
+        if (
+            (lhs := self.add_sub_op_expr())
+            and
+            (op := self.expect('+'))
+            and
+            (rhs := self.mul_div_op_expr())
+        ):
+            return ( 'OP' , 'ADD' , ( lhs , rhs ) , op );
+        self._reset(mark)
+        if (
+            (lhs := self.add_sub_op_expr())
+            and
+            (op := self.expect('-'))
+            and
+            (rhs := self.mul_div_op_expr())
+        ):
+            return ( 'OP' , 'SUB' , ( lhs , rhs ) , op );
+        self._reset(mark)
+        if (
+            (mul_div_op_expr := self.mul_div_op_expr())
+        ):
+            return mul_div_op_expr;
+        self._reset(mark)
+        return None;
+
+    @memoize_left_rec
+    def mul_div_op_expr(self) -> Optional[Any]:
+        # mul_div_op_expr: mul_div_op_expr '*' base_expr | mul_div_op_expr '/' base_expr | base_expr
+        mark = self._mark()
+        if (
+            (lhs := self.mul_div_op_expr())
+            and
+            (op := self.expect('*'))
+            and
+            (rhs := self.base_expr())
+        ):
+            return ( 'OP' , 'MUL' , ( lhs , rhs ) , op );
+        self._reset(mark)
+        if (
+            (lhs := self.mul_div_op_expr())
+            and
+            (op := self.expect('/'))
+            and
+            (rhs := self.base_expr())
+        ):
+            return ( 'OP' , 'DIV' , ( lhs , rhs ) , op );
+        self._reset(mark)
+        if (
+            (base_expr := self.base_expr())
+        ):
+            return base_expr;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def base_expr(self) -> Optional[Any]:
+        # base_expr: '(' expr ')' | slice_expr | iden | value
+        mark = self._mark()
+        if (
+            (tk := self.expect('('))
+            and
+            (val := self.expr())
+            and
+            (self.expect(')'))
+        ):
+            return ( 'OP' , 'PAREN' , ( val , ) , tk );
+        self._reset(mark)
+        if (
+            (slice_expr := self.slice_expr())
+        ):
+            return slice_expr;
+        self._reset(mark)
+        if (
+            (iden := self.iden())
+        ):
+            return iden;
+        self._reset(mark)
+        if (
+            (value := self.value())
+        ):
+            return value;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def slice_expr(self) -> Optional[Any]:
+        # slice_expr: iden sub_op+
+        mark = self._mark()
+        if (
+            (val := self.iden())
+            and
+            (idx := self._loop1_9())
+        ):
+            return ( 'OP' , 'SLICE' , ( val , * idx ) , val [3] );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def sub_op(self) -> Optional[Any]:
+        # sub_op: '[' add_sub_op_expr ']'
+        mark = self._mark()
+        if (
+            (self.expect('['))
+            and
+            (add_sub_op_expr := self.add_sub_op_expr())
+            and
+            (self.expect(']'))
+        ):
+            return add_sub_op_expr;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def value(self) -> Optional[Any]:
+        # value: NUMBER
+        mark = self._mark()
+        if (
+            (number := self.number())
+        ):
+            return ( 'VALUE' , ast . literal_eval ( number . string ) , ( ) , number );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def iden(self) -> Optional[Any]:
+        # iden: NAME
+        mark = self._mark()
+        if (
+            (name := self.name())
+        ):
+            return ( 'IDEN' , name . string , ( ) , name );
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def _loop0_2(self) -> Optional[Any]:
+        # _loop0_2: NEWLINE statement
+        mark = self._mark()
+        children = []
+        while (
+            (self.expect('NEWLINE'))
+            and
+            (elem := self.statement())
+        ):
+            children.append(elem)
+            mark = self._mark()
+        self._reset(mark)
+        return children;
+
+    @memoize
+    def _gather_1(self) -> Optional[Any]:
+        # _gather_1: statement _loop0_2
+        mark = self._mark()
+        if (
+            (elem := self.statement())
+            is not None
+            and
+            (seq := self._loop0_2())
+            is not None
+        ):
+            return [elem] + seq;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def _loop0_4(self) -> Optional[Any]:
+        # _loop0_4: ',' base_expr
+        mark = self._mark()
+        children = []
+        while (
+            (self.expect(','))
+            and
+            (elem := self.base_expr())
+        ):
+            children.append(elem)
+            mark = self._mark()
+        self._reset(mark)
+        return children;
+
+    @memoize
+    def _gather_3(self) -> Optional[Any]:
+        # _gather_3: base_expr _loop0_4
+        mark = self._mark()
+        if (
+            (elem := self.base_expr())
+            is not None
+            and
+            (seq := self._loop0_4())
+            is not None
+        ):
+            return [elem] + seq;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def _loop1_5(self) -> Optional[Any]:
+        # _loop1_5: block
+        mark = self._mark()
+        children = []
+        while (
+            (block := self.block())
+        ):
+            children.append(block)
+            mark = self._mark()
+        self._reset(mark)
+        return children;
+
+    @memoize
+    def _loop0_7(self) -> Optional[Any]:
+        # _loop0_7: ',' iter_expr
+        mark = self._mark()
+        children = []
+        while (
+            (self.expect(','))
+            and
+            (elem := self.iter_expr())
+        ):
+            children.append(elem)
+            mark = self._mark()
+        self._reset(mark)
+        return children;
+
+    @memoize
+    def _gather_6(self) -> Optional[Any]:
+        # _gather_6: iter_expr _loop0_7
+        mark = self._mark()
+        if (
+            (elem := self.iter_expr())
+            is not None
+            and
+            (seq := self._loop0_7())
+            is not None
+        ):
+            return [elem] + seq;
+        self._reset(mark)
+        return None;
+
+    @memoize
+    def _loop0_8(self) -> Optional[Any]:
+        # _loop0_8: rest
+        mark = self._mark()
+        children = []
+        while (
+            (rest := self.rest())
+        ):
+            children.append(rest)
+            mark = self._mark()
+        self._reset(mark)
+        return children;
+
+    @memoize
+    def _loop1_9(self) -> Optional[Any]:
+        # _loop1_9: sub_op
+        mark = self._mark()
+        children = []
+        while (
+            (sub_op := self.sub_op())
+        ):
+            children.append(sub_op)
+            mark = self._mark()
+        self._reset(mark)
+        return children;
+
+    KEYWORDS = ('bin', 'constr', 'cont', 'forall', 'int', 'max', 'min', 'ndarray', 'obj', 'sum', 'var')
+    SOFT_KEYWORDS = ('sparse',)
+
+
+if __name__ == '__main__':
+    from pegen.parser import simple_parser_main
+    simple_parser_main(GeneratedParser)
@@ -0,0 +1,54 @@
+"""The example problems shared by the tests and the benchmarks.
+
+`sources` maps the name of each problem to its program. The tests check
+them against the parse trees kept in `assets`, and `bench` generates data
+of any size for each of them.
+"""
+
+sources = {
+    "knapsack": """var bin x = ndarray (I)
+obj max sum (i:=I) p[i] * x[i]
+constr (sum (i:=I) w[i] * x[i]) <= c""",
+    "travelling_salesman": """var bin x = ndarray (n, n)
+var cont y = ndarray (n)
+obj min sum (i:=n) (j:=n) c[i][j] * x[i][j]
+constr forall (i:=n) (sum (j:=n, i != j) x[i][j]) == 1
+constr forall (i:=n) (sum (j:=n, i != j) x[j][i]) == 1
+constr forall (i:=n, i != 0) (j:=n, j != 0, i != j) y[i] - (n + 1) * x[i][j] >= y[j] - n""",
+    "n_queens": """var bin x = ndarray (n, n)
+constr forall (i:=n) (sum (j:=n) x[i][j]) == 1
+constr forall (j:=n) (sum (i:=n) x[i][j]) == 1
+constr forall (k:=2-n:n-2) (sum (i:=n, 0 <= i - k, i - k < n) x[i][i - k]) <= 1
+constr forall (k:=1:2*n-3) (sum (i:=n, 0 <= k - i, k - i < n) x[i][k - i]) <= 1""",
+    "frequency_assignment": """var bin x = ndarray(N, U)
+var cont z = ndarray(1)
+obj min z[0]
+constr forall (i:=N) (sum (c:=U) x[i][c]) == r[i]
+constr forall (i:=N) (j:=N, i != j) (c1:=U) (c2:=U, c1 <= c2, c2 < c1 + d[i][j]) (x[i][c1] + x[j][c2] <= 1)
+constr forall (i:=N) (c1:=U) (c2:=U, c1 < c2, c2 < c1 + d[i][i]) (x[i][c1] + x[i][c2] <= 1)
+constr forall (i:=N) (c:=U) (z[0] >= (c + 1) * x[i][c])""",
+    "project_scheduling": """var bin x = ndarray (J, T)
+obj min (sum (t:=T) t * x[n + 1][t])
+constr forall (j:=J) (sum (t:=T) x[j][t]) == 1
+constr forall (r:=R) (t:=T) (sum (j:=J) (t2:=0:t, t2 >= (t - p[j] + 1)) u[j][r] * x[j][t2]) <= c[r]
+constr forall (j:=X, s:=Y) (sum (t:=T) t * x[s][t] - t * x[j][t]) >= p[j]""",
+    "job_scheduling": """var cont c = ndarray (1)
+var cont x = ndarray (n, m)
+var bin y = ndarray (n, n, m)
+obj min c[0]
+constr forall (j:=n) (i:=m, i > 0) x[j][machines[j][i]] - x[j][machines[j][i-1]] >= times[j][machines[j][i-1]]
+constr forall (j:=n) (k:=n, k != j) (i:=m) x[j][i] - x[k][i] + M*y[j][k][i] >= times[k][i]
+constr forall (j:=n) (k:=n, k != j) (i:=m) x[k][i] - x[j][i] - M*y[j][k][i] >= times[j][i] - M
+constr forall (j:=n) c[0] - x[j][machines[j][m - 1]] >= times[j][machines[j][m - 1]]""",
+    "cutting_stock": """var int x = ndarray (m, n)
+var bin y = ndarray (n)
+obj min sum (i:=n) y[i]
+constr forall (i:=m) (sum (j:=n) x[i][j]) >= b[i]
+constr forall (j:=n) (sum (i:=m) w[i] * x[i][j]) <= L * y[j]
+constr forall (j:=n, j > 0) y[j - 1] >= y[j]""",
+    "level_packing": """var bin x = ndarray (n, n)
+obj min sum (i:=n) h[i] * x[i][i]
+constr forall (i:=n) (j:=n, h[j] > h[i]) x[i][j] == 0.0
+constr forall (i:=n) (sum (j:=n, h[j] >= h[i]) x[j][i]) == 1
+constr forall (i:=n) (sum (j:=n, j != i, h[j] <= h[i]) w[j] * x[i][j]) <= (W - w[i]) * x[i][i]""",
+}
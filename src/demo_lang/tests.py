@@ -1,74 +1,697 @@
+import concurrent.futures
+import io
 from itertools import product
+import math
+import os
 import pickle
+import tempfile
 import unittest
-from . import compile
-
-sources = {
-    "knapsack": """var bin x = ndarray (I)
-obj max sum (i:=I) p[i] * x[i]
-constr (sum (i:=I) w[i] * x[i]) <= c""",
-    "travelling_salesman": """var bin x = ndarray (n, n)
-var cont y = ndarray (n)
-obj min sum (i:=n) (j:=n) c[i][j] * x[i][j]
-constr forall (i:=n) (sum (j:=n, i != j) x[i][j]) == 1
-constr forall (i:=n) (sum (j:=n, i != j) x[j][i]) == 1
-constr forall (i:=n, i != 0) (j:=n, j != 0, i != j) y[i] - (n + 1) * x[i][j] >= y[j] - n""",
-    "n_queens": """var bin x = ndarray (n, n)
-constr forall (i:=n) (sum (j:=n) x[i][j]) == 1
-constr forall (j:=n) (sum (i:=n) x[i][j]) == 1
-constr forall (k:=2-n:n-2) (sum (i:=n, 0 <= i - k, i - k < n) x[i][i - k]) <= 1
-constr forall (k:=1:2*n-3) (sum (i:=n, 0 <= k - i, k - i < n) x[i][k - i]) <= 1""",
-    "frequency_assignment": """var bin x = ndarray(N, U)
-var cont z = ndarray(1)
-obj min z[0]
-constr forall (i:=N) (sum (c:=U) x[i][c]) == r[i]
-constr forall (i:=N) (j:=N, i != j) (c1:=U) (c2:=U, c1 <= c2, c2 < c1 + d[i][j]) (x[i][c1] + x[j][c2] <= 1)
-constr forall (i:=N) (c1:=U) (c2:=U, c1 < c2, c2 < c1 + d[i][i]) (x[i][c1] + x[i][c2] <= 1)
-constr forall (i:=N) (c:=U) (z[0] >= (c + 1) * x[i][c])""",
-    "project_scheduling": """var bin x = ndarray (J, T)
-obj min (sum (t:=T) t * x[n + 1][t])
-constr forall (j:=J) (sum (t:=T) x[j][t]) == 1
-constr forall (r:=R) (t:=T) (sum (j:=J) (t2:=0:t, t2 >= (t - p[j] + 1)) u[j][r] * x[j][t2]) <= c[r]
-constr forall (j:=X, s:=Y) (sum (t:=T) t * x[s][t] - t * x[j][t]) >= p[j]""",
-    "job_scheduling": """var cont c = ndarray (1)
-var cont x = ndarray (n, m)
-var bin y = ndarray (n, n, m)
-obj min c[0]
-constr forall (j:=n) (i:=m, i > 0) x[j][machines[j][i]] - x[j][machines[j][i-1]] >= times[j][machines[j][i-1]]
-constr forall (j:=n) (k:=n, k != j) (i:=m) x[j][i] - x[k][i] + M*y[j][k][i] >= times[k][i]
-constr forall (j:=n) (k:=n, k != j) (i:=m) x[k][i] - x[j][i] - M*y[j][k][i] >= times[j][i] - M
-constr forall (j:=n) c[0] - x[j][machines[j][m - 1]] >= times[j][machines[j][m - 1]]""",
-    "cutting_stock": """var int x = ndarray (m, n)
-var bin y = ndarray (n)
-obj min sum (i:=n) y[i]
-constr forall (i:=m) (sum (j:=n) x[i][j]) >= b[i]
-constr forall (j:=n) (sum (i:=m) w[i] * x[i][j]) <= L * y[j]
-constr forall (j:=n, j > 0) y[j - 1] >= y[j]""",
-    "level_packing": """var bin x = ndarray (n, n)
-obj min sum (i:=n) h[i] * x[i][i]
-constr forall (i:=n) (j:=n, h[j] > h[i]) x[i][j] == 0.0
-constr forall (i:=n) (sum (j:=n, h[j] >= h[i]) x[j][i]) == 1
-constr forall (i:=n) (sum (j:=n, j != i, h[j] <= h[i]) w[j] * x[i][j]) <= (W - w[i]) * x[i][i]""",
-}
+from . import compile, grammar
+from .problems import sources
+
+
+def freeze(node):
+    """Return `node` with the children lists of older trees made tuples."""
+    kind, value, children, *token = node
+    return (kind, value, tuple(map(freeze, children)), *token)
 
 
 class TestParserMeta(type):
     def __new__(cls, name, bases, attrs):
         for test_name, source in sources.items():
 
-            def problem(self):
+            def problem(self, test_name=test_name, source=source):
                 filename = f"src/demo_lang/assets/{test_name}_ast.pkl"
                 parse_tree = compile.parse(source)
                 with open(filename, "rb") as f:
                     check_tree = pickle.load(f)
-                self.assertEqual(check_tree, parse_tree)
+                self.assertEqual(freeze(check_tree), parse_tree)
 
             problem.__name__ = f"test_{test_name}_problem"
-            attrs[test_name] = problem
+            attrs[problem.__name__] = problem
         return super().__new__(cls, name, bases, attrs)
 
 
-class TestParser(unittest.TestCase, metaclass=TestParserMeta): ...
+class TestParser(unittest.TestCase, metaclass=TestParserMeta):
+
+    def test_parser_matches_grammar(self):
+        with open(grammar.parser_file) as f:
+            shipped = f.read()
+        self.assertEqual(
+            grammar.generate_parser(),
+            shipped,
+            "demo_lang/parser.py is out of date, run `python -m demo_lang.grammar`",
+        )
+
+
+class TestParseCache(unittest.TestCase):
+
+    def test_repeated_source_is_parsed_once(self):
+        cache = compile.ParseCache(maxsize=2)
+        source = sources["travelling_salesman"]
+        first = cache.parse(source)
+        second = cache.parse(source)
+        self.assertEqual(first, compile.parse(source))
+        self.assertIs(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.parse(sources["knapsack"])
+        cache.parse(sources["n_queens"])
+        self.assertNotIn(cache.digest(source), cache.entries)
+
+    def test_disk_cache_is_shared(self):
+        source = sources["cutting_stock"]
+        with tempfile.TemporaryDirectory() as directory:
+            compile.ParseCache(directory=directory).parse(source)
+            cache = compile.ParseCache(directory=directory)
+            self.assertTrue(
+                os.path.exists(os.path.join(directory, f"{cache.digest(source)}.pkl"))
+            )
+            self.assertEqual(cache.parse(source), compile.parse(source))
+
+
+class TestCompiler(unittest.TestCase):
+
+    def test_program_is_compiled_once(self):
+        source = sources["job_scheduling"]
+        statements = compile.compile_source(source)
+        self.assertIs(statements, compile.compile_source(source))
+        self.assertEqual(
+            [s.__name__ for s in statements],
+            [f"statement_{line}" for line in range(1, 9)],
+        )
+
+    def test_program_is_instantiated_with_new_data(self):
+        program = compile.compile(sources["knapsack"])
+        data = [
+            {"p": [1, 2, 3, 4][:n], "w": [1, 1, 1, 1][:n], "c": 2, "I": n}
+            for n in range(1, 5)
+        ]
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            gens = list(
+                pool.map(lambda d: program.instantiate(f"knapsack {d['I']}", d), data)
+            )
+        self.assertEqual([gen.model.num_cols for gen in gens], [1, 2, 3, 4])
+        self.assertEqual(len({id(gen.model) for gen in gens}), 4)
+        self.assertIs(gens[0].statements, program.statements)
+        with self.assertRaises(AttributeError):
+            program.source = ""
+
+    def test_forall_outside_constraint(self):
+        with self.assertRaises(compile.CompilerError):
+            compile.compile_source("var bin x = ndarray (n)\nobj min forall (i:=n) x[i]")
+
+    def test_parameters_are_patched(self):
+        source = sources["cutting_stock"]
+        data = {"n": 3, "L": 10, "m": 3, "w": [3, 4, 5], "b": [1, 2, 1]}
+        gen = compile.ModelGenerator("cutting_stock", source, data, parameters=["b"])
+        gen.generate()
+        num_rows = gen.model.num_rows
+        self.assertEqual(gen.update({"b": [2, 2, 3]}), 2)
+        self.assertEqual(gen.model.num_rows, num_rows)
+        check = compile.ModelGenerator("cutting_stock", source, {**data, "b": [2, 2, 3]})
+        check.generate()
+        self.assertEqual(
+            [constr.rhs for constr in gen.model.constrs],
+            [constr.rhs for constr in check.model.constrs],
+        )
+        with self.assertRaises(ValueError):
+            gen.update({"L": 12})
+        with self.assertRaisesRegex(compile.CompilerError, "Parameter 'm'"):
+            compile.ModelGenerator("cutting_stock", source, data, parameters=["m"])
+        data = {"p": [1, 2], "w": [1, 1], "c": 1, "I": 2}
+        gen = compile.compile(sources["knapsack"]).instantiate("knapsack", data, parameters=["c", "p"])
+        gen.update({"c": 2, "p": [3, 4]})
+        self.assertEqual(gen.model.constrs[0].rhs, 2)
+        objective = {var.idx: val for var, val in gen.model.objective.expr.items()}
+        self.assertEqual(objective, {0: 3, 1: 4})
+
+    def test_warm_start_matches_arrays(self):
+        source = sources["knapsack"]
+        data = {"p": [10, 13, 18, 31], "w": [11, 15, 20, 35], "c": 47, "I": 4}
+        gen = compile.ModelGenerator("knapsack", source, data)
+        self.assertEqual(gen.solution(), {})
+        gen.generate()
+        gen.model.verbose = 0
+        gen.model.optimize()
+        solution = gen.solution()
+        self.assertEqual(solution["x"], ((4,), [1, 1, 1, 0]))
+        data = {"p": [10, 13, 18, 31, 7], "w": [11, 15, 20, 35, 10], "c": 50, "I": 5}
+        gen = compile.ModelGenerator("knapsack", source, data)
+        gen.generate()
+        self.assertEqual(gen.warm_start(solution), 4)
+        self.assertEqual(gen.warm_start({"x": ((2, 2), [0, 0, 1, 0])}), 0)
+        gen = compile.ModelGenerator("knapsack", source, data, names=False)
+        gen.generate()
+        with self.assertRaises(ValueError):
+            gen.warm_start(solution)
+
+    def test_background_solve(self):
+        data = {"p": [10, 13, 18, 31], "w": [11, 15, 20, 35], "c": 47, "I": 4}
+        finished = []
+        solve = compile.BackgroundSolve(
+            "knapsack", sources["knapsack"], {**data, "os": os}, on_done=finished.append
+        )
+        self.assertTrue(solve.wait(60))
+        self.assertEqual(finished, [solve])
+        self.assertEqual(solve.status, "OPTIMAL")
+        self.assertEqual((solve.objective_value, solve.gap), (41, 0))
+        self.assertEqual(solve.scope, {"x": [1, 1, 1, 0]})
+        self.assertEqual(solve.solution["x"], ((4,), [1, 1, 1, 0]))
+        solve = compile.BackgroundSolve("knapsack", sources["knapsack"], {"I": 4})
+        self.assertTrue(solve.wait(60))
+        self.assertEqual(solve.status, "failed")
+        self.assertIn("Undefiend variable", solve.error)
+        data = {"n": 40, "c": [[abs(i - j) % 7 + 1 for j in range(40)] for i in range(40)]}
+        solve = compile.BackgroundSolve("tsp", sources["travelling_salesman"], data)
+        solve.cancel()
+        self.assertTrue(solve.wait(60))
+        self.assertEqual(solve.status, "cancelled")
+        self.assertIsNone(solve.scope)
+
+    def test_solution_arrays(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        data = {"n": 3, "c": [[0, 1, 1], [1, 0, 1], [1, 1, 0]]}
+        source = sources["travelling_salesman"]
+        gen = compile.ModelGenerator("travelling_salesman", source, data)
+        scope = gen.generate()
+        self.assertIsNone(scope["x"].x)
+        gen.model.verbose = 0
+        gen.model.optimize()
+        arrays = compile.solution_arrays(scope)
+        self.assertEqual(list(arrays), ["x", "y"])
+        self.assertEqual(arrays["x"].shape, (3, 3))
+        self.assertEqual(
+            arrays["x"].tolist(), [[var.x for var in row] for row in scope["x"].tolist()]
+        )
+        self.assertEqual(scope["x"][1].x.tolist(), arrays["x"][1].tolist())
+        self.assertIsNone(scope["x"].rc)
+        gen.model.optimize(relax=True)
+        self.assertEqual(
+            scope["x"].rc.tolist(), [[var.rc for var in row] for row in scope["x"].tolist()]
+        )
+
+    def test_sparse_array_creates_used_variables(self):
+        source = """var bin x = sparse (n, n)
+obj min sum (i:=n) (j:=n, i != j) c[i][j] * x[i][j]
+constr forall (i:=n) (sum (j:=n, i != j) x[i][j]) == 1
+constr forall (j:=n) (sum (i:=n, i != j) x[i][j]) == 1"""
+        data = {"n": 4, "c": [[abs(i - j) for j in range(4)] for i in range(4)]}
+        gen = compile.ModelGenerator("assignment", source, data)
+        scope = gen.generate()
+        self.assertEqual(gen.model.num_cols, 12)
+        self.assertNotIn((2, 2), scope["x"].columns)
+        self.assertEqual(scope["x"][0][1].name, "x_0_1")
+        self.assertEqual(scope["x"][-1].index(0), scope["x"].index(3, 0))
+        with self.assertRaises(IndexError):
+            scope["x"].index(4, 0)
+        self.assertEqual(gen.model.num_cols, 12)
+        self.assertFalse(any(s.detachable for s in compile.compile_source(source)))
+        self.assertIsNone(gen.estimate()[0]["variables"])
+        gen.model.verbose = 0
+        gen.model.optimize()
+        self.assertEqual(gen.model.objective_value, 4)
+        shape, values = gen.solution()["x"]
+        self.assertEqual((shape, len(values), sum(values.values())), ((4, 4), 12, 4))
+        # Entries that were never used stay out of the solved model.
+        self.assertEqual([scope["x"][i][i].x for i in range(4)], [0] * 4)
+        with self.assertRaises(KeyError):
+            scope["x"].index(2, 2)
+        self.assertEqual(gen.model.num_cols, 12)
+        # `sparse` is still a name everywhere else.
+        source = """var cont x = sparse (n)
+constr x[0] <= sparse"""
+        gen = compile.ModelGenerator("name", source, {"n": 2, "sparse": 3})
+        gen.generate()
+        self.assertEqual([c.rhs for c in gen.model.constrs], [3])
+
+    def test_presolve(self):
+        source = """var int x = ndarray (n)
+constr forall (i:=n) 2 * x[i] <= 7
+constr forall (i:=n) 0 - x[i] <= 0 - 1
+constr forall (i:=n) x[i] + x[0] <= 5
+constr forall (i:=n) x[i] + x[0] <= 4
+constr x[0] + x[1] - x[1] == x[0]"""
+        for processes in [None, 2]:
+            gen = compile.ModelGenerator("presolve", source, {"n": 3}, presolve=True)
+            gen.generate(processes)
+            self.assertEqual(
+                [(v.lb, v.ub) for v in gen.model.vars], [(1, 2), (1, 3), (1, 3)]
+            )
+            self.assertEqual([c.rhs for c in gen.model.constrs], [4, 4])
+            self.assertEqual(
+                gen.rows.presolved,
+                {"bounds": 8, "fixed": 0, "dropped": 1, "duplicates": 2},
+            )
+        # A variable fixed again after a flush is counted once.
+        fixed = """var int x = ndarray (n)
+constr x[0] == 1"""
+        gen = compile.ModelGenerator("presolve", fixed, {"n": 3}, presolve=True)
+        gen.generate()
+        gen.rows.add_constr(gen.model.vars[0] <= 1)
+        gen.rows.flush()
+        self.assertEqual(gen.rows.presolved["fixed"], 1)
+        self.assertEqual(gen.rows.presolved["bounds"], 2)
+        with self.assertRaisesRegex(compile.CompilerError, "line 7"):
+            compile.ModelGenerator(
+                "presolve", source + "\nconstr x[1] >= 4", {"n": 3}, presolve=True
+            ).generate()
+        with self.assertRaises(ValueError):
+            compile.ModelGenerator(
+                "presolve", source, {"n": 3}, parameters=["n"], presolve=True
+            )
+
+    def test_sparse_data_skips_zeros(self):
+        source = """var cont x = ndarray (n, n)
+obj min sum (i:=n) (j:=n) c[i][j] * x[i][j]
+constr forall (i:=n) (sum (j:=n, j >= i) 2 * d[i][j] * x[i][j]) >= 1"""
+        data = {
+            "n": 3,
+            "c": [[1, 0, 2]] * 3,
+            "d": {0: {1: 2.0}, 1: {0: 1.0, 2: 0.0}, 2: {2: 3.0}},
+        }
+        gen = compile.ModelGenerator("sparse", source, data)
+        scope = gen.generate()
+        x = scope["x"]
+        self.assertEqual(
+            [
+                {var.idx: val for var, val in constr.expr.expr.items()}
+                for constr in gen.model.constrs
+            ],
+            [{x.index(0, 1): 4.0}, {0: 0.0}, {x.index(2, 2): 6.0}],
+        )
+        objective = {var.idx: val for var, val in gen.model.objective.expr.items()}
+        self.assertEqual(
+            objective, {x.index(i, j): c for i in range(3) for j, c in [(0, 1), (2, 2)]}
+        )
+        self.assertEqual(compile.stored(compile.SparseRow({5: 1, 1: 2}), range(4)), [1])
+        self.assertEqual(compile.stored([0, 1], range(4)), range(4))
+        # The row is only read when the body would read it.
+        source = """var cont x = ndarray (m)
+constr forall (i:=n) x[0] + (sum (j:=m, i < k) d[i][j] * x[j]) <= 1
+constr forall (i:=n) (sum (j:=M) d[i][j] * x[j]) <= 1"""
+        data = {"n": 3, "m": 2, "k": 2, "M": 0, "d": [{0: 1.0}, {1: 2.0}]}
+        gen = compile.ModelGenerator("sparse", source, data)
+        gen.generate()
+        self.assertEqual(
+            [
+                {var.idx: val for var, val in constr.expr.expr.items()}
+                for constr in gen.model.constrs[:3]
+            ],
+            [{0: 2.0}, {0: 1.0, 1: 2.0}, {0: 1.0}],
+        )
+        self.assertEqual(gen.model.num_rows, 6)
+
+    def test_tree_is_not_modified(self):
+        tree = compile.parse(sources["travelling_salesman"])
+        frozen = pickle.dumps(tree)
+        first, second = compile.Compiler(tree), compile.Compiler(tree)
+        first.program()
+        second.program()
+        self.assertEqual(pickle.dumps(tree), frozen)
+        self.assertEqual(first.lines, second.lines)
+        tree = compile.parse("var bin x = ndarray (n)\nobj min forall (i:=n) x[i]")
+        frozen = pickle.dumps(tree)
+        with self.assertRaises(compile.CompilerError):
+            compile.Compiler(tree).program()
+        self.assertEqual(pickle.dumps(tree), frozen)
+        with self.assertRaises(compile.CompilerError):
+            compile.Compiler(tree).program()
+
+    def test_scope_layers_over_locals(self):
+        data = {"p": [1, 2], "w": [1, 1], "c": 1, "I": 2}
+        gen = compile.ModelGenerator("knapsack", sources["knapsack"], data)
+        scope = gen.generate()
+        self.assertEqual(list(gen.declared), ["x"])
+        self.assertNotIn("x", data)
+        self.assertIs(scope["p"], data["p"])
+        self.assertIs(scope["x"], gen.declared["x"])
+
+    def test_block_filters_become_ranges(self):
+        source = """var bin x = ndarray (n)
+constr forall (i:=S, i >= a, i - 1 < b, i != 3) x[i] <= 1"""
+        for S in [8, range(8), list(range(8)), range(0, 8, 2)]:
+            gen = compile.ModelGenerator(
+                "narrow", source, {"n": 8, "S": S, "a": 1.5, "b": 4.2}
+            )
+            gen.generate()
+            expected = [i for i in compile.iterate(S) if 1.5 <= i < 5.2 and i != 3]
+            self.assertEqual(gen.model.num_rows, len(expected))
+        # The filters of an empty set are never evaluated.
+        source = """var bin x = ndarray (n)
+constr forall (i:=n) (j:=U, j < d[i]) x[i] <= j"""
+        gen = compile.ModelGenerator("empty", source, {"n": 2, "U": 0, "d": [1]})
+        gen.generate()
+        self.assertEqual(gen.model.num_rows, 0)
+        # Infinite bounds cut the range at its ends, with NaN no element passes.
+        source = """var bin x = ndarray (n)
+constr forall (i:=n, i < M) x[i] <= 1
+constr forall (i:=n, i >= L, i <= M) x[i] <= 1"""
+        for M, L, rows in [
+            (math.inf, -math.inf, 8),
+            (-math.inf, 1, 0),
+            (math.nan, 1, 0),
+            (2.5, math.nan, 3),
+        ]:
+            gen = compile.ModelGenerator("infinite", source, {"n": 4, "M": M, "L": L})
+            gen.generate()
+            self.assertEqual(gen.model.num_rows, rows)
+        self.assertIsNone(compile.narrow(range(4), (math.nan,), ()))
+
+    def test_block_filters_are_vectorized(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        source = """var bin x = ndarray (n, n)
+constr forall (i:=n) (j:=n, h[j] > h[i], j != i) x[i][j] == 0
+constr forall (i:=S) (sum (j:=n, d[i][j] >= h[i] - 4) x[j][i]) == 1"""
+        h = [(7 * i) % 11 for i in range(40)]
+        d = [[(i + j) % 5 for j in range(40)] for i in range(3)]
+        expected = sum(h[j] > h[i] for i in range(40) for j in range(40))
+        for data in [
+            {"h": h, "d": d},
+            {"h": numpy.array(h), "d": numpy.array(d)},
+            {"h": dict(enumerate(h)), "d": [dict(enumerate(row)) for row in d]},
+        ]:
+            gen = compile.ModelGenerator("vector", source, {"n": 40, "S": 3, **data})
+            gen.generate()
+            self.assertEqual(gen.model.num_rows, expected + 3)
+            self.assertEqual(
+                [len(constr.expr.expr) for constr in gen.model.constrs[expected:]],
+                [sum(d[i][j] >= h[i] - 4 for j in range(40)) for i in range(3)],
+            )
+        self.assertEqual(compile.select(range(2, 6), [lambda v: v % 2 == 0], minimum=0), [2, 4])
+        self.assertIsNone(compile.select([2, 3], [lambda v: v > 2], minimum=0))
+        self.assertIsNone(compile.select(range(4), [lambda v: v > 2], None, minimum=0))
+        # A filter guarding a subscript is applied before it.
+        source = """var bin x = ndarray (n)
+constr forall (j:=n, j != 39, h[j] > 0) x[j] <= 1
+constr forall (j:=n, j < k, h[j] > 0) x[j] <= 1"""
+        gen = compile.ModelGenerator("guard", source, {"n": 40, "k": 39, "h": h[1:]})
+        gen.generate()
+        self.assertEqual(gen.model.num_rows, 2 * sum(v > 0 for v in h[1:]))
+        self.assertIsNone(compile.as_array([[1, 2], [3]], 2))
+        self.assertIsNone(compile.as_array([1, 2], 2))
+        self.assertEqual(compile.as_array([[1, 2]], 2).shape, (1, 2))
+
+    def test_invariants_are_hoisted(self):
+        source = """var cont x = ndarray (n)
+constr forall (i:=n) (j:=J) x[i] - 2 * (sum (k:=n) w[k] * x[k]) + (sum (k:=n) w[k] * x[k]) <= (m + 1) * j"""
+        compiler = compile.Compiler(compile.parse(source))
+        compiler.program()
+        statement = compiler.lines[compiler.lines.index("def statement_2(gen, scope):") :]
+        self.assertEqual(sum(line.lstrip().startswith("for ") for line in statement), 3)
+        self.assertEqual(sum("(g_m + 1)" in line for line in statement), 1)
+        gen = compile.ModelGenerator("hoist", source, {"n": 3, "J": 2, "w": [1, 2, 0], "m": 4})
+        gen.generate()
+        self.assertEqual(
+            [
+                ({var.idx: val for var, val in constr.expr.expr.items()}, constr.rhs)
+                for constr in gen.model.constrs
+            ],
+            [
+                ({0: -1 + (i == 0), 1: -2 + (i == 1), **({2: 1} if i == 2 else {})}, 5 * j)
+                for i in range(3)
+                for j in range(2)
+            ],
+        )
+        # Nothing is computed before the filters guarding it.
+        source = """var cont x = ndarray (m)
+constr forall (i:=n) (sum (j:=m, d[i] != 0) x[j] / d[i]) <= 1
+constr forall (i:=n) (sum (j:=m, i < k) a[i] * x[j]) <= 1"""
+        data = {"n": 3, "m": 2, "d": [1, 0, 2], "k": 2, "a": [3, 4]}
+        gen = compile.ModelGenerator("guard", source, data)
+        gen.generate()
+        self.assertEqual(
+            [
+                sorted((var.idx, val) for var, val in constr.expr.expr.items())
+                for constr in gen.model.constrs
+            ],
+            [[(0, 1), (1, 1)], [(0, 0)], [(0, 0.5), (1, 0.5)], [(0, 3), (1, 3)]]
+            + [[(0, 4), (1, 4)], [(0, 0)]],
+        )
+        # Nor before the loops it was taken out of, which may be empty.
+        source = """var cont x = ndarray (m)
+constr forall (i:=n) (sum (j:=0:k[i]) x[j] / d[i]) <= 1
+constr forall (i:=n) (sum (j:=K) a[i] * x[j]) <= 1"""
+        data = {"n": 3, "m": 2, "k": [1, -1, -1], "d": [1, 0, 0], "K": 0, "a": [3, 4]}
+        gen = compile.ModelGenerator("empty", source, data)
+        gen.generate()
+        self.assertEqual(gen.model.num_rows, 6)
+        data["K"] = 2
+        with self.assertRaises(IndexError):
+            compile.ModelGenerator("empty", source, data).generate()
+
+    def test_ndarray_any_dimension(self):
+        source = "var bin x = ndarray (2, 3, 1, 4)\nvar int y = ndarray (n)"
+        for names in [True, False]:
+            gen = compile.ModelGenerator("ndarray", source, {"n": 5}, names=names)
+            gen.generate()
+            x, y = gen.declared["x"], gen.declared["y"]
+            self.assertEqual((x.shape, x.size, len(x)), ((2, 3, 1, 4), 24, 2))
+            self.assertEqual(gen.model.num_cols, 29)
+            self.assertIs(x[1][2][0][3], gen.model.vars[x.index(1, 2, 0, 3)])
+            self.assertIs(x[-1][-1][0][-1], x[1][2][0][3])
+            self.assertEqual(y.index(0), 24)
+            self.assertEqual(y[4].var_type, compile.mip.INTEGER)
+            self.assertEqual(len(x.tolist()[1][2][0]), 4)
+            self.assertEqual(x.var_name(1, 2, 0, 3), "x_1_2_0_3")
+            self.assertEqual(x[1][2][0][3].name == "x_1_2_0_3", names)
+            with self.assertRaises(IndexError):
+                x[2]
+
+    def test_linear_terms_are_accumulated(self):
+        source = """var cont x = ndarray (n)
+obj min sum (i:=n) (j:=n) w[i] * x[j] / 2 + x[0]
+constr (sum (i:=n) 2 * x[i] - x[i] * t) + s >= x[0] - 1"""
+        data = {"n": 3, "w": [1, 2, 3], "t": 1}
+        gen = compile.ModelGenerator("linear", source, data)
+        s = data["s"] = gen.model.add_var("s")
+        scope = gen.generate()
+        x = scope["x"]
+        objective = gen.model.objective.expr
+        self.assertEqual([objective[x[j]] for j in range(3)], [12, 3, 3])
+        constr = gen.model.constrs[0].expr
+        coefs = {var.idx: coef for var, coef in constr.expr.items()}
+        self.assertEqual([coefs.get(x.index(j), 0) for j in range(3)], [0, 1, 1])
+        self.assertEqual(coefs[s.idx], 1)
+        self.assertEqual((constr.sense, constr.const), (">", 1))
+
+    def test_rows_are_loaded_in_chunks(self):
+        source = """var bin x = ndarray (n)
+constr forall (i:=n) x[i] + x[0] <= e + i"""
+        data = {"n": 10}
+        gen = compile.ModelGenerator("rows", source, data)
+        gen.rows.chunk = 3
+        e = data["e"] = gen.model.add_var("e")
+        scope = gen.generate()
+        self.assertEqual((gen.rows.num_rows, gen.rows.num_nonzeros), (10, 29))
+        self.assertEqual(len(gen.model.constrs), 10)
+        for i, constr in enumerate(gen.model.constrs):
+            coefs = {var.idx: coef for var, coef in constr.expr.expr.items()}
+            expected = {scope["x"].index(i): 1, scope["x"].index(0): 1, e.idx: -1}
+            expected[scope["x"].index(0)] += i == 0
+            self.assertEqual(coefs, expected)
+            self.assertEqual((constr.expr.sense, constr.rhs), ("<", i))
+
+    def test_parallel_generation(self):
+        data = {
+            "n": 5,
+            "m": 3,
+            "machines": [[0, 1, 2], [2, 0, 1], [1, 2, 0], [0, 2, 1], [2, 1, 0]],
+            "times": [[1, 2, 3], [3, 1, 2], [2, 3, 1], [1, 1, 1], [3, 2, 2]],
+            "M": 100,
+        }
+        rows = []
+        for processes in [None, 2]:
+            gen = compile.ModelGenerator("job", sources["job_scheduling"], data)
+            gen.generate(processes)
+            rows.append(
+                [
+                    (sorted((v.idx, c) for v, c in constr.expr.expr.items()), constr.rhs)
+                    for constr in gen.model.constrs
+                ]
+            )
+        self.assertEqual(len(rows[0]), 5 * 2 + 2 * 5 * 4 * 3 + 5)
+        self.assertEqual(rows[0], rows[1])
+        # A constraint without `forall` is generated by a single worker.
+        source = """var cont x = ndarray (n)
+constr (sum (i:=n) x[i]) <= 1
+constr forall (i:=n) x[i] <= 1"""
+        for processes in [None, 4]:
+            gen = compile.ModelGenerator("single", source, {"n": 3})
+            gen.generate(processes)
+            self.assertEqual(gen.model.num_rows, 4)
+
+    def test_estimate_matches_model(self):
+        data = {
+            "n": 4,
+            "c": [[1] * 4] * 4,
+            "N": 3,
+            "U": 6,
+            "r": [2, 1, 2],
+            "d": [[2, 1, 0], [1, 3, 2], [0, 2, 1]],
+        }
+        for problem in ["travelling_salesman", "n_queens", "frequency_assignment"]:
+            gen = compile.ModelGenerator(problem, sources[problem], data)
+            records = gen.estimate()
+            self.assertEqual(gen.model.num_cols, 0)
+            gen.generate()
+            self.assertEqual(sum(r["variables"] for r in records), gen.model.num_cols)
+            self.assertEqual(sum(r["rows"] for r in records), gen.model.num_rows)
+            self.assertEqual(sum(r["nonzeros"] for r in records), gen.model.num_nz)
+        # Zero coefficients are counted, although the model leaves them out.
+        d = {0: {1: 2.0}, 1: {0: 1.0, 2: 0.5}, 2: {}}
+        for source, data, estimated, nonzeros in [
+            (sources["knapsack"], {"I": 4, "p": [1] * 4, "w": [0, 0, 0, 1], "c": 1}, 4, 1),
+            (
+                "var bin x = ndarray (n, n)\n"
+                "constr (sum (i:=n) (j:=n) d[i][j] * x[i][j]) <= 1",
+                {"n": 3, "d": d},
+                9,
+                3,
+            ),
+        ]:
+            gen = compile.ModelGenerator("zeros", source, data)
+            records = gen.estimate()
+            gen.generate()
+            self.assertEqual(gen.model.num_nz, nonzeros)
+            self.assertEqual(records[-1]["nonzeros"], estimated)
+
+    def test_profile_counts_loops(self):
+        data = {"n": 5, "h": [3, 1, 2, 5, 4], "w": [1, 1, 1, 1, 1], "W": 3}
+        gen = compile.ModelGenerator("level", sources["level_packing"], data)
+        report = gen.profile()
+        self.assertEqual(
+            [(r["kind"], r["line"]) for r in report],
+            [("var", 1), ("obj", 2), ("sum", 2), ("constr", 3), ("forall", 3)]
+            + [("constr", 4), ("forall", 4), ("sum", 4), ("constr", 5)]
+            + [("forall", 5), ("sum", 5)],
+        )
+        self.assertEqual(report[0]["variables"], 25)
+        self.assertTrue(all(r["peak_memory"] >= 0 for r in report))
+        self.assertGreater(report[0]["peak_memory"], 0)
+        self.assertEqual((report[4]["tuples"], report[4]["rejected"]), (30, 15))
+        self.assertEqual(report[3]["rows"], 10)
+        self.assertEqual(sum(r["rows"] for r in report if r["kind"] == "constr"), 20)
+        self.assertEqual(gen.model.num_rows, 20)
+        self.assertIn("20 rows", compile.profile_summary(report))
+
+    def test_statements_are_streamed(self):
+        data = {
+            "n": 5,
+            "m": 3,
+            "machines": [[0, 1, 2], [2, 0, 1], [1, 2, 0], [0, 2, 1], [2, 1, 0]],
+            "times": [[1, 2, 3], [3, 1, 2], [2, 3, 1], [1, 1, 1], [3, 2, 2]],
+            "M": 100,
+        }
+        source = sources["job_scheduling"]
+        gen = compile.ModelGenerator("job", source, data)
+        gen.generate()
+        expected = [
+            (sorted((v.idx, c) for v, c in constr.expr.expr.items()), constr.rhs)
+            for constr in gen.model.constrs
+        ]
+        lines = ("\n" + source.replace("\n", "\n\n# comment\n") + "\n").splitlines(True)
+        for program, ahead in [(source, 2), (lines, 0), (iter(lines), 1)]:
+            streamed = compile.stream("job", program, data, ahead=ahead)
+            self.assertEqual(list(streamed.declared), ["c", "x", "y"])
+            self.assertEqual(
+                [
+                    (sorted((v.idx, c) for v, c in constr.expr.expr.items()), constr.rhs)
+                    for constr in streamed.model.constrs
+                ],
+                expected,
+            )
+        for method in ["estimate", "profile", "generate"]:
+            with self.assertRaisesRegex(ValueError, "stream"):
+                getattr(streamed, method)()
+        with self.assertRaisesRegex(compile.CompilerError, "Undefiend variable"):
+            compile.stream("job", source, {"n": 5, "m": 3})
+        statements = list(compile.parse_statements(io.StringIO(sources["knapsack"] + "\nvar x").readline))
+        self.assertEqual(
+            list(map(compile.untokenized, statements)),
+            list(map(compile.untokenized, compile.parse(sources["knapsack"])[2])),
+        )
+
+    def test_model_is_written_to_file(self):
+        data = {
+            "n": 4,
+            "c": [[abs(i - j) for j in range(4)] for i in range(4)],
+            "m": 3,
+            "b": [3, 1, 2],
+            "w": [2, 3, 1],
+            "L": 5,
+        }
+        sparse = """var bin x = sparse (n, n)
+obj max (sum (i:=n) (j:=n, i != j) c[i][j] * x[i][j]) + 2
+constr forall (i:=n) (sum (j:=n, i != j) x[i][j]) == 1
+constr forall (j:=n) (sum (i:=n, i != j) x[i][j]) <= 1"""
+
+        def rows(model):
+            return [
+                (c.name, sorted((v.name, k) for v, k in c.expr.expr.items()))
+                + (c.expr.sense, c.rhs)
+                for c in model.constrs
+            ]
+
+        def columns(model, sign=1):
+            return [(v.name, v.var_type, v.lb, v.ub, sign * v.obj) for v in model.vars]
+
+        with tempfile.TemporaryDirectory() as directory:
+            for source in [sources["cutting_stock"], sparse]:
+                gen = compile.ModelGenerator("written", source, data)
+                gen.generate()
+                program = compile.compile(source)
+                for name in ["model.lp", "model.mps", "model.lp.gz", "model.mps.gz"]:
+                    path = os.path.join(directory, name)
+                    writer = program.write(path, data, "written", chunk=3, budget=4)
+                    self.assertEqual(writer.rows.num_rows, gen.model.num_rows)
+                    model = compile.mip.Model()
+                    model.verbose = 0
+                    model.read(path)
+                    self.assertEqual(rows(model), rows(gen.model))
+                    if ".lp" in name:
+                        self.assertEqual(model.sense, gen.model.sense)
+                        self.assertEqual(columns(model), columns(gen.model))
+                    else:
+                        # A maximized objective is minimized negated.
+                        self.assertEqual(model.sense, compile.mip.MINIMIZE)
+                        sign = -1 if gen.model.sense == compile.mip.MAXIMIZE else 1
+                        self.assertEqual(columns(model, sign), columns(gen.model))
+            self.assertEqual(
+                sorted(os.listdir(directory)),
+                ["model.lp", "model.lp.gz", "model.mps", "model.mps.gz"],
+            )
+            with open(os.path.join(directory, "model.mps")) as f:
+                text = f.read()
+            self.assertNotIn("OBJSENSE", text)
+            self.assertIn("    RHS obj 2.0\n", text)
+            with self.assertRaisesRegex(ValueError, "format"):
+                program.write(os.path.join(directory, "model.txt"), data)
+            with self.assertRaisesRegex(compile.CompilerError, "linear constraint"):
+                source = "var bin x = ndarray (n)\nconstr x[0] * x[1] <= 1"
+                compile.compile(source).write(os.path.join(directory, "model.lp"), data)
+
+    def test_undefined_variable(self):
+        gen = compile.ModelGenerator("knapsack", sources["knapsack"], {"I": 3})
+        with self.assertRaisesRegex(compile.CompilerError, "Undefiend variable"):
+            gen.generate()
+
+
+class TestBench(unittest.TestCase):
+
+    def test_every_problem_runs(self):
+        from . import bench
+
+        for problem in sources:
+            record = bench.run(problem, 4, seed=1)
+            self.assertEqual(record, {**record, "problem": problem, "size": 4})
+            self.assertGreater(record["num_cols"], 0)
+            self.assertEqual(bench.run(problem, 4, seed=1)["num_nz"], record["num_nz"])
 
 
 class TestEvaluator(unittest.TestCase):